@@ -0,0 +1,49 @@
+"""Cost of saving and evicting timestamped images as the archive grows.
+
+The archive is filled with empty images over 30 day folders, then an
+image is added and evicted at a time, as the entity saves at its limit.
+
+    python benchmarks/bench_archive.py
+"""
+import tempfile
+import time
+from pathlib import Path
+
+import stub  # noqa: F401, puts the repository on sys.path
+
+from custom_components.amazon_rekognition.image_processing import SnapshotArchive
+
+SIZES = (1000, 10000, 100000)
+REPEATS = 200
+
+
+def main():
+    print(f"{'images':>7} {'us/add':>7} {'us/evict':>9}")
+    for size in SIZES:
+        with tempfile.TemporaryDirectory() as folder:
+            archive = SnapshotArchive(Path(folder))
+            archive.set_limits("cam")
+            for index in range(size):
+                path = archive.path(f"cam_{index}.jpg", f"day{index % 30}")
+                path.touch()
+                archive.add("cam", path, 0, index)
+            archive.set_limits("cam", max_files=size)
+            add = evict = 0.0
+            for index in range(size, size + REPEATS):
+                path = archive.path(f"cam_{index}.jpg", f"day{index % 30}")
+                path.touch()
+                start = time.perf_counter()
+                archive.add("cam", path, 0, index)
+                add += time.perf_counter() - start
+                start = time.perf_counter()
+                archive.evict("cam", index)
+                evict += time.perf_counter() - start
+            archive.close()
+            print(
+                f"{size:>7} {add / REPEATS * 1e6:>7.0f} "
+                f"{evict / REPEATS * 1e6:>9.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Throughput of concurrent scans as the camera count grows.
+
+Compares running process_image in the Home Assistant executor (the base class
+behaviour) with async_process_image and its dedicated Rekognition pool. The
+probe column is the worst wait seen by an unrelated job submitted to the Home
+Assistant executor while the scans run.
+
+    python benchmarks/bench_concurrency.py
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from stub import StubHass, StubRekognitionClient, make_entity, make_frame, run
+
+LATENCY = 0.2
+ROUNDS = 3
+WORKERS = 8
+
+
+def make_entities(hass, count, executor):
+    entities = []
+    for index in range(count):
+        entity = make_entity(
+            index,
+            rekognition_client=StubRekognitionClient(LATENCY),
+            executor=executor,
+        )
+        entity.hass = hass
+        entities.append(entity)
+    return entities
+
+
+async def probe(hass, stop):
+    """Record how long trivial jobs wait for a Home Assistant executor thread."""
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await hass.async_add_executor_job(lambda: None)
+        worst = max(worst, time.perf_counter() - start)
+        await asyncio.sleep(0.01)
+    return worst
+
+
+async def bench(count, mode):
+    hass = StubHass(asyncio.get_running_loop())
+    executor = ThreadPoolExecutor(max_workers=WORKERS)
+    entities = make_entities(hass, count, executor)
+    frame = make_frame()
+
+    if mode == "hass_executor":
+        scan = lambda entity: hass.async_add_executor_job(entity.process_image, frame)
+    else:
+        scan = lambda entity: entity.async_process_image(frame)
+
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(hass, stop))
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        await asyncio.gather(*(scan(entity) for entity in entities))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    worst_wait = await probe_task
+    executor.shutdown()
+    hass.executor.shutdown()
+    return count * ROUNDS / elapsed, worst_wait
+
+
+def main():
+    print(f"{'cameras':>8} {'mode':>14} {'frames/s':>9} {'probe ms':>9}")
+    for count in (1, 5, 10, 20, 40):
+        for mode in ("hass_executor", "dedicated_pool"):
+            fps, worst_wait = run(bench(count, mode))
+            print(f"{count:>8} {mode:>14} {fps:>9.1f} {worst_wait * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Event bus load per frame for each event configuration.
+
+The response has 3 people and 30 labels, typical of a busy scene. Bytes are
+the size of the event data serialized to JSON, as the recorder stores it,
+and the time is that of building the event data and serializing it.
+
+    python benchmarks/bench_events.py
+"""
+import json
+import time
+
+from stub import make_entity, make_frame, make_response
+
+from custom_components.amazon_rekognition.image_processing import Frame
+
+REPEATS = 1000
+
+
+class RecordingBus:
+    """Event bus that serializes the event data like the recorder."""
+
+    def __init__(self):
+        self.events = 0
+        self.bytes = 0
+
+    def fire(self, event_type, event_data=None):
+        self.events += 1
+        self.bytes += len(json.dumps(event_data))
+
+
+def make_busy_response():
+    response = make_response(3)
+    for index in range(30):
+        response["Labels"].append(
+            {"Name": f"Label{index}", "Confidence": 50 + index * 1.6, "Instances": []}
+        )
+    return response
+
+
+CONFIGS = {
+    "per event": {},
+    "allowlist": {"label_events": ["label1", "label2", "label3"]},
+    "min 90%": {"label_min_confidence": 90},
+    "batched": {"batch_events": True},
+    "batched 90%": {"batch_events": True, "label_min_confidence": 90},
+}
+
+
+def main():
+    response = make_busy_response()
+    frame = Frame(make_frame())
+    print(f"{'events':>12} {'events/frame':>13} {'bytes/frame':>12} {'us/frame':>9}")
+    for name, options in CONFIGS.items():
+        entity = make_entity(**options)
+        entity.process_response(response, frame)
+        bus = RecordingBus()
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            entity.fire_events(bus.fire, None)
+        elapsed = (time.perf_counter() - start) / REPEATS
+        print(
+            f"{name:>12} {bus.events / REPEATS:>13.0f} "
+            f"{bus.bytes / REPEATS:>12.0f} {elapsed * 1e6:>9.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
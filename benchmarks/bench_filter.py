@@ -0,0 +1,63 @@
+"""Parsing a response and filtering it for targets in the ROI.
+
+Responses have hundreds of instances over many label names, and the entity
+has many targets. Times are per response.
+
+    python benchmarks/bench_filter.py
+"""
+import random
+import time
+
+from stub import make_entity, make_frame
+
+from custom_components.amazon_rekognition.image_processing import Frame
+
+REPEATS = 50
+
+
+def make_response(instances, names):
+    labels = []
+    for index in range(names):
+        labels.append(
+            {
+                "Name": f"Label{index}",
+                "Confidence": 90.0,
+                "Instances": [
+                    {
+                        "BoundingBox": {
+                            "Width": random.random() / 4,
+                            "Height": random.random() / 4,
+                            "Left": random.random() * 0.75,
+                            "Top": random.random() * 0.75,
+                        },
+                        "Confidence": random.uniform(50, 100),
+                    }
+                    for _ in range(instances // names)
+                ],
+            }
+        )
+    return {"Labels": labels}
+
+
+def main():
+    random.seed(0)
+    frame = Frame(make_frame())
+    print(f"{'instances':>10} {'targets':>8} {'us/response':>12}")
+    for instances, targets in ((10, 2), (100, 10), (500, 50), (1000, 100)):
+        response = make_response(instances, names=max(targets, 10))
+        entity = make_entity(
+            targets=[
+                {"target": f"label{index}", "confidence": 80.0}
+                for index in range(targets)
+            ],
+            roi_x_max=0.5,
+        )
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            entity.process_response(response, frame)
+        elapsed = (time.perf_counter() - start) / REPEATS
+        print(f"{instances:>10} {targets:>8} {elapsed * 1e6:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
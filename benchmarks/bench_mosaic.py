@@ -0,0 +1,94 @@
+"""Mosaic mode against a Rekognition call per frame.
+
+The stub detector reports a person for each coloured rectangle, so the IoU
+of the reported box with the drawn rectangle shows how well positions survive
+the tiling. It says nothing about how well Rekognition copes with the lower
+resolution of each tile.
+
+    python benchmarks/bench_mosaic.py
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from stub import (
+    RectangleRekognitionClient,
+    StubHass,
+    make_entity,
+    make_rectangle_frame,
+    run,
+)
+
+from custom_components.amazon_rekognition.image_processing import MosaicBatcher
+
+LATENCY = 0.1
+WINDOW = 0.05
+MAX_TILES = 4
+
+
+def iou(box, bounding_box):
+    x_min = max(box[0], bounding_box["x_min"])
+    y_min = max(box[1], bounding_box["y_min"])
+    x_max = min(box[2], bounding_box["x_max"])
+    y_max = min(box[3], bounding_box["y_max"])
+    intersection = max(x_max - x_min, 0) * max(y_max - y_min, 0)
+    union = (
+        (box[2] - box[0]) * (box[3] - box[1])
+        + bounding_box["width"] * bounding_box["height"]
+        - intersection
+    )
+    return intersection / union
+
+
+async def bench(count, mosaic_mode):
+    hass = StubHass(asyncio.get_running_loop())
+    client = RectangleRekognitionClient(LATENCY)
+    executor = ThreadPoolExecutor(max_workers=8)
+    mosaic = None
+    if mosaic_mode:
+        mosaic = MosaicBatcher(hass, client, executor, WINDOW, MAX_TILES, 75)
+    entities = []
+    frames = []
+    for index in range(count):
+        entity = make_entity(
+            index, rekognition_client=client, executor=executor, mosaic=mosaic
+        )
+        entity.hass = hass
+        entities.append(entity)
+        frames.append(make_rectangle_frame(index))
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            entity.async_process_image(image)
+            for entity, (image, _) in zip(entities, frames)
+        )
+    )
+    elapsed = time.perf_counter() - start
+
+    scores = []
+    for entity, (_, box) in zip(entities, frames):
+        found = entity._targets_found
+        scores.append(iou(box, found[0]["bounding_box"]) if len(found) == 1 else 0)
+    executor.shutdown()
+    hass.executor.shutdown()
+    return client.calls, sum(scores) / count, min(scores), elapsed
+
+
+def main():
+    print(
+        f"{'cameras':>8} {'mode':>9} {'calls':>6} {'mean IoU':>9} "
+        f"{'min IoU':>8} {'wall ms':>8}"
+    )
+    for count in (4, 8, 16):
+        for mosaic_mode in (False, True):
+            calls, mean_iou, min_iou, elapsed = run(bench(count, mosaic_mode))
+            mode = "mosaic" if mosaic_mode else "per frame"
+            print(
+                f"{count:>8} {mode:>9} {calls:>6} {mean_iou:>9.3f} "
+                f"{min_iou:>8.3f} {elapsed * 1000:>8.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
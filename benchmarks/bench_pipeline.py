@@ -0,0 +1,180 @@
+"""End to end process_image against local stand-ins for Rekognition and S3.
+
+Runs every combination of configuration, camera resolution and number of
+detections, and reports frames/sec, p50/p99 latency per frame, memory per
+frame and Rekognition calls per frame. Memory is the peak of Python
+allocations while processing a frame plus the raster the entity keeps for
+saving, which Pillow allocates outside of Python.
+
+    python benchmarks/bench_pipeline.py --json results.json
+    python benchmarks/bench_pipeline.py --compare results.json
+
+With --compare the results are checked against an earlier run, and the exit
+status is 1 if any case regressed by more than --tolerance.
+"""
+import argparse
+import functools
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from stub import (
+    StubHass,
+    StubRekognitionClient,
+    StubS3Client,
+    make_entity,
+    make_frame,
+    make_response,
+)
+
+RESOLUTIONS = ((640, 480), (1920, 1080), (3840, 2160))
+DETECTIONS = (0, 5, 50)
+DISTINCT_FRAMES = 4
+
+
+def configs(folder, latency):
+    """Return the entity options of each configuration."""
+    return {
+        "baseline": {},
+        "scale": {"scale": 0.5},
+        "save": {"save_file_folder": folder, "save_timestamped_file": True},
+        "s3": {"s3_client": StubS3Client(latency), "s3_bucket": "bench"},
+        "roi": {"roi_x_max": 0.5, "roi_y_min": 0.25, "roi_crop": True},
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def make_frames(width, height):
+    """Return a few distinct frames, so results can't be reused between frames."""
+    return [make_frame(width, height) for _ in range(DISTINCT_FRAMES)]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q * (len(values) - 1)))]
+
+
+def bench(options, resolution, detections, frames, latency):
+    client = StubRekognitionClient(latency, make_response(detections))
+    entity = make_entity(rekognition_client=client, **options)
+    entity.hass = StubHass(None)
+    images = make_frames(*resolution)
+    entity.process_image(images[-1])  # warm up
+    client.calls = 0
+
+    latencies = []
+    start = time.perf_counter()
+    for index in range(frames):
+        frame_start = time.perf_counter()
+        entity.process_image(images[index % DISTINCT_FRAMES])
+        latencies.append(time.perf_counter() - frame_start)
+    elapsed = time.perf_counter() - start
+    calls = client.calls
+
+    tracemalloc.start()
+    entity.process_image(images[0])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    image = entity._frame.image
+    raster = image.width * image.height * len(image.getbands())
+    entity.hass.executor.shutdown()
+
+    return {
+        "fps": round(frames / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "memory_kb": round((peak + raster) / 1024),
+        "api_calls_per_frame": round(calls / frames, 3),
+        "state": entity.state,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print the cases that regressed, and return whether there were any."""
+    previous = {
+        (case["config"], case["resolution"], case["detections"]): case
+        for case in baseline["results"]
+    }
+    regressed = False
+    for case in results:
+        key = (case["config"], case["resolution"], case["detections"])
+        old = previous.get(key)
+        if old is None:
+            continue
+        checks = (
+            ("fps", old["fps"] * (1 - tolerance) > case["fps"]),
+            ("p99_ms", old["p99_ms"] * (1 + tolerance) < case["p99_ms"]),
+            ("memory_kb", old["memory_kb"] * (1 + tolerance) < case["memory_kb"]),
+            (
+                "api_calls_per_frame",
+                old["api_calls_per_frame"] < case["api_calls_per_frame"],
+            ),
+        )
+        for metric, worse in checks:
+            if worse:
+                regressed = True
+                print(
+                    f"REGRESSION {' '.join(map(str, key))} {metric}: "
+                    f"{old[metric]} -> {case[metric]}"
+                )
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=10)
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="stub round trip in seconds"
+    )
+    parser.add_argument("--json", type=Path, help="write the results to this file")
+    parser.add_argument("--compare", type=Path, help="results of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = []
+    print(
+        f"{'config':>8} {'resolution':>10} {'dets':>5} {'fps':>7} {'p50 ms':>7} "
+        f"{'p99 ms':>7} {'mem kB':>7} {'calls':>6}"
+    )
+    with tempfile.TemporaryDirectory() as folder:
+        for name, options in configs(Path(folder), args.latency).items():
+            for width, height in RESOLUTIONS:
+                for detections in DETECTIONS:
+                    result = bench(
+                        options, (width, height), detections, args.frames, args.latency
+                    )
+                    case = {
+                        "config": name,
+                        "resolution": f"{width}x{height}",
+                        "detections": detections,
+                        **result,
+                    }
+                    results.append(case)
+                    print(
+                        f"{name:>8} {case['resolution']:>10} {detections:>5} "
+                        f"{case['fps']:>7.1f} {case['p50_ms']:>7.1f} "
+                        f"{case['p99_ms']:>7.1f} {case['memory_kb']:>7} "
+                        f"{case['api_calls_per_frame']:>6}"
+                    )
+
+    output = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "frames": args.frames,
+        "latency": args.latency,
+        "results": results,
+    }
+    if args.json:
+        args.json.write_text(json.dumps(output, indent=2))
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""CPU time of saving an annotated image, per save.
+
+The entity has an ROI, two zones and a timestamped file as well as the
+latest file, and the frame has 5 targets. The frame is decoded before
+timing, as the pipeline decodes it once whatever is saved.
+
+    python benchmarks/bench_save.py
+"""
+import tempfile
+import time
+from pathlib import Path
+
+from stub import make_entity, make_frame, make_response
+
+from custom_components.amazon_rekognition.image_processing import Frame
+
+REPEATS = 10
+ZONES = [
+    {"name": "door", "points": [(0.1, 0.2), (0.3, 0.2), (0.3, 0.9), (0.1, 0.9)]},
+    {"name": "path", "points": [(0.4, 0.6), (0.9, 0.5), (0.9, 0.9)]},
+]
+RESOLUTIONS = ((640, 480), (1920, 1080), (3840, 2160))
+CONFIGS = {
+    "jpg": {},
+    "jpg optimize": {"save_optimize": True},
+    "jpg progressive": {"save_progressive": True},
+    "png": {"save_file_format": "png"},
+}
+
+
+def main():
+    response = make_response(5)
+    print(f"{'config':>16} {'resolution':>10} {'ms/save':>8} {'kB':>6}")
+    with tempfile.TemporaryDirectory() as folder:
+        for name, options in CONFIGS.items():
+            # PNG is slow to encode, 4K would take seconds per save
+            resolutions = RESOLUTIONS[:2] if name == "png" else RESOLUTIONS
+            for width, height in resolutions:
+                entity = make_entity(
+                    save_file_folder=Path(folder),
+                    save_timestamped_file=True,
+                    roi_x_min=0.05,
+                    roi_x_max=0.95,
+                    roi_y_min=0.1,
+                    zones=ZONES,
+                    **options,
+                )
+                frame = Frame(make_frame(width, height, sigma=16))
+                frame.image.load()
+                entity.process_response(response, frame)
+                entity.save_image(entity._targets_found, Path(folder))  # warm up
+                start = time.process_time()
+                for _ in range(REPEATS):
+                    saved = entity.save_image(entity._targets_found, Path(folder))
+                elapsed = (time.process_time() - start) / REPEATS
+                size = Path(saved).stat().st_size / 1000
+                print(
+                    f"{name:>16} {width}x{height:<5} {elapsed * 1000:>8.1f} "
+                    f"{size:>6.0f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""CPU time of preparing a 4K camera snapshot for Rekognition at each scale.
+
+The decoded column is the size of the raster that the frame keeps around for
+saving, which dominates the memory used per frame.
+
+    python benchmarks/bench_scale.py
+"""
+import time
+
+from stub import make_entity, make_frame
+
+REPEATS = 10
+
+
+def main():
+    image = make_frame(3840, 2160)
+    print(f"{'scale':>6} {'ms/frame':>9} {'decoded MB':>11} {'sent kB':>8}")
+    for scale in (1.0, 0.75, 0.5, 0.25):
+        entity = make_entity(scale=scale)
+        start = time.process_time()
+        for _ in range(REPEATS):
+            frame = entity.prepare_image(image)
+            frame.image.load()  # saving would decode it
+        elapsed = (time.process_time() - start) / REPEATS
+        width, height = frame.image.size
+        decoded = width * height * len(frame.image.getbands()) / 1e6
+        print(
+            f"{scale:>6} {elapsed * 1000:>9.1f} {decoded:>11.1f} "
+            f"{len(frame.data) / 1000:>8.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Time taken by setup_platform for many platform blocks.
+
+Each block has its own camera, as in a configuration.yaml with one
+amazon_rekognition block per camera. The first use column is the time for
+every entity to get hold of its Rekognition client, which includes creating
+any client that setup_platform deferred. No AWS requests are made.
+
+    python benchmarks/bench_startup.py
+"""
+import time
+
+from stub import StubHass
+
+from custom_components.amazon_rekognition.image_processing import (
+    PLATFORM_SCHEMA,
+    setup_platform,
+)
+
+BLOCKS = 20
+
+
+def main():
+    hass = StubHass(None)
+    hass.bus.listen_once = lambda event_type, listener: None
+    entities = []
+    start = time.perf_counter()
+    for index in range(BLOCKS):
+        config = PLATFORM_SCHEMA(
+            {
+                "platform": "amazon_rekognition",
+                "aws_access_key_id": "AKIDBENCH",
+                "aws_secret_access_key": "secret",
+                "source": [{"entity_id": f"camera.bench_{index}"}],
+            }
+        )
+        setup_platform(hass, config, entities.extend)
+    setup_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    clients = {id(entity._aws_rekognition_client.meta) for entity in entities}
+    first_use_time = time.perf_counter() - start
+
+    print(f"{'blocks':>7} {'setup ms':>9} {'first use ms':>13} {'clients':>8}")
+    print(
+        f"{BLOCKS:>7} {setup_time * 1000:>9.1f} "
+        f"{first_use_time * 1000:>13.1f} {len(clients):>8}"
+    )
+    hass.executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""Local stand-ins for Rekognition and Home Assistant used by the benchmarks."""
+import asyncio
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from custom_components.amazon_rekognition.image_processing import (  # noqa: E402
+    DEFAULT_TARGETS,
+    ObjectDetection,
+)
+from custom_components.amazon_rekognition.tests import MOCK_RESPONSE  # noqa: E402
+
+# Home Assistant sizes its executor from the CPU count, a small Pi has 4 cores
+HASS_EXECUTOR_WORKERS = 4 * 5
+
+
+class StubRekognitionClient:
+    """Rekognition client that sleeps for a fixed latency before replying."""
+
+    def __init__(self, latency=0.1, response=MOCK_RESPONSE):
+        self.latency = latency
+        self.response = response
+        self.calls = 0
+
+    def detect_labels(self, Image):
+        self.calls += 1
+        time.sleep(self.latency)
+        return self.response
+
+
+class StubS3Client:
+    """S3 client that sleeps for a fixed latency and keeps only object sizes."""
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.uploads = 0
+        self.bytes = 0
+
+    def put_object(self, Body, Bucket, Key):
+        self.uploads += 1
+        self.bytes += len(Body)
+        time.sleep(self.latency)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, Config=None):
+        self.put_object(Fileobj.read(), Bucket, Key)
+
+
+def make_response(detections, seed=0):
+    """Return a response with this many people at random positions."""
+    import random
+
+    rng = random.Random(seed)
+    instances = []
+    for _ in range(detections):
+        width, height = rng.uniform(0.05, 0.2), rng.uniform(0.1, 0.4)
+        instances.append(
+            {
+                "BoundingBox": {
+                    "Width": width,
+                    "Height": height,
+                    "Left": rng.uniform(0, 1 - width),
+                    "Top": rng.uniform(0, 1 - height),
+                },
+                "Confidence": rng.uniform(80, 100),
+            }
+        )
+    labels = [{"Name": "Person", "Confidence": 99.0, "Instances": instances}]
+    if detections:
+        labels.append({"Name": "Human", "Confidence": 99.0, "Instances": []})
+    return {"Labels": labels}
+
+
+class StubBus:
+    """Event bus that only counts events."""
+
+    def __init__(self):
+        self.events = 0
+
+    def fire(self, event_type, event_data=None):
+        self.events += 1
+
+    def async_fire(self, event_type, event_data=None):
+        self.events += 1
+
+
+class StubHass:
+    """Just enough of HomeAssistant to drive an ObjectDetection entity."""
+
+    def __init__(self, loop, executor_workers=HASS_EXECUTOR_WORKERS):
+        self.loop = loop
+        self.bus = StubBus()
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers)
+
+    def async_add_executor_job(self, target, *args):
+        return self.loop.run_in_executor(self.executor, target, *args)
+
+
+def make_entity(index=0, **kwargs):
+    """Return an ObjectDetection entity, kwargs override the defaults."""
+    config = dict(
+        rekognition_client=StubRekognitionClient(),
+        s3_client=None,
+        region="us-east-1",
+        targets=[dict(target) for target in DEFAULT_TARGETS],
+        confidence=80,
+        roi_y_min=0.0,
+        roi_x_min=0.0,
+        roi_y_max=1.0,
+        roi_x_max=1.0,
+        scale=1.0,
+        show_boxes=True,
+        save_file_format="jpg",
+        save_file_folder=None,
+        save_timestamped_file=False,
+        always_save_latest_file=False,
+        s3_bucket=None,
+        camera_entity=f"camera.bench_{index}",
+    )
+    config.update(kwargs)
+    entity = ObjectDetection(**config)
+    entity.entity_id = f"image_processing.bench_{index}"
+    return entity
+
+
+def make_frame(width=640, height=480, sigma=64):
+    """Return the JPEG bytes of a synthetic camera frame."""
+    image = Image.effect_noise((width, height), sigma).convert("RGB")
+    with io.BytesIO() as output:
+        image.save(output, format="JPEG")
+        return output.getvalue()
+
+
+def run(coro):
+    """Run a coroutine on a fresh event loop."""
+    return asyncio.run(coro)
+
+
+PALETTE = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0)]
+
+
+class RectangleRekognitionClient(StubRekognitionClient):
+    """Detects a person wherever a rectangle of a PALETTE colour is drawn."""
+
+    def detect_labels(self, Image):
+        import numpy as np
+        from PIL import Image as PILImage
+
+        self.calls += 1
+        time.sleep(self.latency)
+        pixels = np.asarray(PILImage.open(io.BytesIO(Image["Bytes"])).convert("RGB"))
+        height, width, _ = pixels.shape
+        instances = []
+        for color in PALETTE:
+            match = (np.abs(pixels.astype(int) - color).sum(axis=2) < 60).nonzero()
+            if len(match[0]) == 0:
+                continue
+            top, bottom = match[0].min(), match[0].max() + 1
+            left, right = match[1].min(), match[1].max() + 1
+            instances.append(
+                {
+                    "BoundingBox": {
+                        "Width": (right - left) / width,
+                        "Height": (bottom - top) / height,
+                        "Left": left / width,
+                        "Top": top / height,
+                    },
+                    "Confidence": 99.0,
+                }
+            )
+        label = {"Name": "Person", "Confidence": 99.0, "Instances": instances}
+        return {"Labels": [label]}
+
+
+def make_rectangle_frame(index, width=1280, height=720, seed=None):
+    """Return a frame with one PALETTE rectangle, and the rectangle's box."""
+    import random
+
+    rng = random.Random(index if seed is None else seed)
+    box_width, box_height = rng.uniform(0.05, 0.3), rng.uniform(0.1, 0.4)
+    x_min, y_min = rng.uniform(0, 1 - box_width), rng.uniform(0, 1 - box_height)
+    box = (x_min, y_min, x_min + box_width, y_min + box_height)
+    image = Image.new("RGB", (width, height), (128, 128, 128))
+    image.paste(
+        PALETTE[index % len(PALETTE)],
+        (
+            round(box[0] * width),
+            round(box[1] * height),
+            round(box[2] * width),
+            round(box[3] * height),
+        ),
+    )
+    with io.BytesIO() as output:
+        image.save(output, format="JPEG")
+        return output.getvalue(), box
@@ -1,18 +1,34 @@
 """
 Platform that will perform object detection.
 """
-from collections import namedtuple, Counter
+import asyncio
+import bisect
+from collections import namedtuple, Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import functools
+import glob
+import hashlib
 import io
+import json
 import logging
+import math
+import queue
+import random
 import re
+import sqlite3
+import subprocess
+import threading
 import time
 from pathlib import Path
 
+import numpy as np
 from PIL import Image, ImageDraw, UnidentifiedImageError
 
 import homeassistant.helpers.config_validation as cv
 import homeassistant.util.dt as dt_util
 import voluptuous as vol
+from homeassistant.components import camera
 from homeassistant.components.image_processing import (
     ATTR_CONFIDENCE,
     CONF_CONFIDENCE,
@@ -25,9 +41,14 @@ from homeassistant.components.image_processing import (
     ImageProcessingEntity,
 )
 from homeassistant.core import split_entity_id
+from homeassistant.exceptions import HomeAssistantError
 from homeassistant.util.pil import draw_box
 
-from homeassistant.const import ATTR_ENTITY_ID, ATTR_NAME
+from homeassistant.const import (
+    ATTR_ENTITY_ID,
+    ATTR_NAME,
+    EVENT_HOMEASSISTANT_STOP,
+)
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -55,23 +76,80 @@ SUPPORTED_REGIONS = [
 ]
 
 CONF_BOTO_RETRIES = "boto_retries"
+CONF_MAX_POOL_CONNECTIONS = "max_pool_connections"
 CONF_SAVE_FILE_FORMAT = "save_file_format"
 CONF_SAVE_FILE_FOLDER = "save_file_folder"
 CONF_SAVE_TIMESTAMPTED_FILE = "save_timestamped_file"
 CONF_ALWAYS_SAVE_LATEST_FILE = "always_save_latest_file"
 CONF_SHOW_BOXES = "show_boxes"
 CONF_SCALE = "scale"
+CONF_JPEG_QUALITY = "jpeg_quality"
 CONF_TARGET = "target"
 CONF_TARGETS = "targets"
 CONF_S3_BUCKET = "s3_bucket"
+CONF_MAX_CONCURRENT_REQUESTS = "max_concurrent_requests"
+CONF_REKOGNITION_WORKERS = "rekognition_workers"
+CONF_DEDUP_MAX_DISTANCE = "dedup_max_distance"
+CONF_DEDUP_TTL = "dedup_ttl"
+CONF_MOTION_THRESHOLD = "motion_threshold"
+CONF_SAVE_WORKERS = "save_workers"
+CONF_SAVE_QUEUE_SIZE = "save_queue_size"
+CONF_SAVE_QUEUE_POLICY = "save_queue_policy"
 
 CONF_ROI_Y_MIN = "roi_y_min"
 CONF_ROI_X_MIN = "roi_x_min"
 CONF_ROI_Y_MAX = "roi_y_max"
 CONF_ROI_X_MAX = "roi_x_max"
+CONF_ROI_CROP = "roi_crop"
+CONF_ROI_CROP_MARGIN = "roi_crop_margin"
+CONF_ZONES = "zones"
+CONF_DIAGNOSTICS = "diagnostics"
+CONF_BATCH_EVENTS = "batch_events"
+CONF_LABEL_EVENTS = "label_events"
+CONF_LABEL_MIN_CONFIDENCE = "label_min_confidence"
+CONF_ATTRIBUTES = "attributes"
+CONF_TRACKING = "tracking"
+CONF_SHARE_CAMERA = "share_camera"
+CONF_SAVE_MAX_FILES = "save_max_files"
+CONF_SAVE_MAX_SIZE = "save_max_size"
+CONF_SAVE_MAX_AGE = "save_max_age"
+CONF_STREAM = "stream"
+CONF_STREAM_INTERVAL = "stream_interval"
+CONF_STREAM_IDLE_INTERVAL = "stream_idle_interval"
+CONF_RESULT_CACHE_SIZE = "result_cache_size"
+CONF_RESULT_CACHE_MAX_AGE = "result_cache_max_age"
+CONF_DETECTOR = "detector"
+CONF_LOCAL_MODEL = "local_model"
+CONF_LOCAL_LABELS = "local_labels"
+CONF_CASCADE_MIN_CONFIDENCE = "cascade_min_confidence"
+CONF_CASCADE_MAX_CONFIDENCE = "cascade_max_confidence"
+CONF_SAVE_QUALITY = "save_quality"
+CONF_SAVE_OPTIMIZE = "save_optimize"
+CONF_SAVE_PROGRESSIVE = "save_progressive"
+CONF_TRACK_MIN_IOU = "track_min_iou"
+CONF_TRACK_MAX_MISSED = "track_max_missed"
+CONF_MAX_ATTRIBUTE_ITEMS = "max_attribute_items"
+CONF_MAX_REQUESTS_PER_SECOND = "max_requests_per_second"
+CONF_PRIORITY = "priority"
+CONF_MOSAIC_WINDOW = "mosaic_window"
+CONF_MOSAIC_MAX_TILES = "mosaic_max_tiles"
+CONF_POINTS = "points"
 
 DATETIME_FORMAT = "%Y-%m-%d_%H.%M.%S"
 DEFAULT_BOTO_RETRIES = 5
+DEFAULT_MAX_POOL_CONNECTIONS = 10  # the botocore default
+DEFAULT_MAX_CONCURRENT_REQUESTS = 1
+DEFAULT_REKOGNITION_WORKERS = 4
+DEFAULT_DEDUP_TTL = 60  # seconds
+DEDUP_CACHE_SIZE = 8
+HASH_SIZE = 8  # the hash has HASH_SIZE * HASH_SIZE bits
+MOTION_WIDTH = 64  # width in pixels of the ROI when scoring motion
+MOTION_PIXEL_DELTA = 25  # grey levels a pixel must change by to count as motion
+MOTION_BACKGROUND_RATE = 0.2  # weight of the new frame in the background
+DEFAULT_SAVE_QUEUE_SIZE = 10
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+BLOCK = "block"
 PERSON = "person"
 DEFAULT_TARGETS = [{CONF_TARGET: PERSON}]
 DEFAULT_ROI_Y_MIN = 0.0
@@ -79,15 +157,62 @@ DEFAULT_ROI_Y_MAX = 1.0
 DEFAULT_ROI_X_MIN = 0.0
 DEFAULT_ROI_X_MAX = 1.0
 DEAULT_SCALE = 1.0
+DEFAULT_JPEG_QUALITY = 75
 DEFAULT_ROI = (
     DEFAULT_ROI_Y_MIN,
     DEFAULT_ROI_X_MIN,
     DEFAULT_ROI_Y_MAX,
     DEFAULT_ROI_X_MAX,
 )
+DEFAULT_ROI_CROP_MARGIN = 0.05
+DEFAULT_PRIORITY = 0
+DEFAULT_SAVE_QUALITY = 75  # the Pillow default
+RESULT_CACHE_FILE = "amazon_rekognition_cache.db"
+ARCHIVE_INDEX_FILE = "amazon_rekognition_archive.db"
+ARCHIVE_INTERVAL = 60  # seconds between checks for images past their max age
+ARCHIVE_BATCH_SIZE = 500  # images evicted per query
+FAN_OUT_WINDOW = 1.0  # seconds a shared image or response is reused for
+DEFAULT_STREAM_INTERVAL = 1.0  # seconds between frames while active
+DEFAULT_STREAM_IDLE_INTERVAL = 5.0  # seconds between frames while idle
+STREAM_ACTIVE_TIME = 10.0  # seconds a stream stays active after motion or a target
+STREAM_QUEUE_SIZE = 2  # frames waiting between stages, older frames are dropped
+STREAM_RETRY_DELAY = 5.0  # seconds before reopening a stream which ended
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_MAX_FRAME_SIZE = 16 * 1024 * 1024  # larger frames are discarded as garbage
+FFMPEG_BINARY = "ffmpeg"
+DEFAULT_RESULT_CACHE_MAX_AGE = 24 * 60 * 60  # seconds
+RESULT_CACHE_EXPIRY_INTERVAL = 60  # seconds between removals of expired results
+REKOGNITION = "rekognition"
+LOCAL = "local"
+CASCADE = "cascade"
+LOCAL_MIN_CONFIDENCE = 10  # local detections below this are discarded
+DEFAULT_CASCADE_MIN_CONFIDENCE = 30
+DEFAULT_CASCADE_MAX_CONFIDENCE = 80
+MINIMAL = "minimal"
+STANDARD = "standard"
+FULL = "full"
+DEFAULT_MAX_ATTRIBUTE_ITEMS = 10  # of all_objects and labels, in the standard profile
+THROTTLING_ERRORS = ["ThrottlingException", "ProvisionedThroughputExceededException"]
+THROTTLE_RETRIES = 3
+THROTTLE_BACKOFF = 0.5  # seconds, doubled on each retry
+RATE_DECREASE = 0.5  # the rate is multiplied by this when throttled
+RATE_INCREASE = 0.05  # fraction of the max rate restored on each success
+MIN_RATE_FRACTION = 0.05  # the rate never drops below this fraction of the max
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DEFAULT_MOSAIC_MAX_TILES = 4
+MOSAIC_TILE_SIZE = (1280, 720)  # frames are fitted into tiles of this size
+MAX_ZONES = 64  # zones are bits of the lookup grid
+DEFAULT_TRACK_MIN_IOU = 0.3
+DEFAULT_TRACK_MAX_MISSED = 2  # frames an object may be missed before departing
+TRACK_MAX_CENTROID_DISTANCE = 0.05  # matches objects which moved off their box
+ZONE_GRID_MAX_SIZE = 1024  # longest side of the zone lookup grid, in pixels
 
 EVENT_OBJECT_DETECTED = "rekognition.object_detected"
 EVENT_LABEL_DETECTED = "rekognition.label_detected"
+EVENT_IMAGE_SAVED = "rekognition.image_saved"
+EVENT_FRAME_PROCESSED = "rekognition.frame_processed"
+EVENT_OBJECT_DEPARTED = "rekognition.object_departed"
 
 BOX = "box"
 FILE = "file"
@@ -96,6 +221,9 @@ SAVED_FILE = "saved_file"
 MIN_CONFIDENCE = 0.1
 JPG = "jpg"
 PNG = "png"
+PIL_FORMATS = {JPG: "JPEG", PNG: "PNG"}
+S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024  # smaller images are sent in one request
+S3_MAX_CONCURRENCY = 4  # threads per multipart upload
 
 # rgb(red, green, blue)
 RED = (255, 0, 0)  # For objects within the ROI
@@ -111,6 +239,38 @@ TARGETS_SCHEMA = {
     ),
 }
 
+ZONES_SCHEMA = {
+    vol.Required(CONF_NAME): cv.string,
+    vol.Required(CONF_POINTS): vol.All(
+        cv.ensure_list,
+        [
+            vol.All(
+                vol.ExactSequence([cv.small_float, cv.small_float]), vol.Coerce(tuple)
+            )
+        ],
+        vol.Length(min=3),
+    ),
+}
+
+
+
+def validate_detector(config):
+    """Check the options of the local and cascade detectors."""
+    if config[CONF_DETECTOR] == REKOGNITION:
+        return config
+    if not config.get(CONF_LOCAL_MODEL) or not config.get(CONF_LOCAL_LABELS):
+        raise vol.Invalid(
+            f"The {config[CONF_DETECTOR]} detector requires "
+            f"{CONF_LOCAL_MODEL} and {CONF_LOCAL_LABELS}"
+        )
+    if config[CONF_CASCADE_MIN_CONFIDENCE] >= config[CONF_CASCADE_MAX_CONFIDENCE]:
+        raise vol.Invalid(
+            f"{CONF_CASCADE_MIN_CONFIDENCE} must be below "
+            f"{CONF_CASCADE_MAX_CONFIDENCE}"
+        )
+    return config
+
+
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
     {
         vol.Optional(CONF_REGION, default=DEFAULT_REGION): vol.In(SUPPORTED_REGIONS),
@@ -123,20 +283,122 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
         vol.Optional(CONF_ROI_X_MIN, default=DEFAULT_ROI_X_MIN): cv.small_float,
         vol.Optional(CONF_ROI_Y_MAX, default=DEFAULT_ROI_Y_MAX): cv.small_float,
         vol.Optional(CONF_ROI_X_MAX, default=DEFAULT_ROI_X_MAX): cv.small_float,
+        vol.Optional(CONF_ROI_CROP, default=False): cv.boolean,
+        vol.Optional(
+            CONF_ROI_CROP_MARGIN, default=DEFAULT_ROI_CROP_MARGIN
+        ): cv.small_float,
+        vol.Optional(CONF_ZONES, default=[]): vol.All(
+            cv.ensure_list, [vol.Schema(ZONES_SCHEMA)], vol.Length(max=MAX_ZONES)
+        ),
         vol.Optional(CONF_SCALE, default=DEAULT_SCALE): vol.All(
             vol.Coerce(float, vol.Range(min=0.1, max=1))
         ),
+        vol.Optional(CONF_JPEG_QUALITY, default=DEFAULT_JPEG_QUALITY): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=95)
+        ),
         vol.Optional(CONF_SAVE_FILE_FOLDER): cv.isdir,
         vol.Optional(CONF_SAVE_FILE_FORMAT, default=JPG): vol.In([JPG, PNG]),
         vol.Optional(CONF_SAVE_TIMESTAMPTED_FILE, default=False): cv.boolean,
         vol.Optional(CONF_ALWAYS_SAVE_LATEST_FILE, default=False): cv.boolean,
         vol.Optional(CONF_S3_BUCKET): cv.string,
         vol.Optional(CONF_SHOW_BOXES, default=True): cv.boolean,
+        vol.Optional(CONF_SAVE_QUALITY, default=DEFAULT_SAVE_QUALITY): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=95)
+        ),
+        vol.Optional(CONF_SAVE_OPTIMIZE, default=False): cv.boolean,
+        vol.Optional(CONF_SAVE_PROGRESSIVE, default=False): cv.boolean,
+        vol.Optional(CONF_SHARE_CAMERA, default=False): cv.boolean,
+        vol.Optional(CONF_SAVE_MAX_FILES): cv.positive_int,
+        vol.Optional(CONF_SAVE_MAX_SIZE): vol.All(
+            vol.Coerce(float), vol.Range(min=0.1)
+        ),
+        vol.Optional(CONF_SAVE_MAX_AGE): vol.All(
+            vol.Coerce(float), vol.Range(min=0.01)
+        ),
+        vol.Optional(CONF_STREAM, default=False): cv.boolean,
+        vol.Optional(CONF_STREAM_INTERVAL, default=DEFAULT_STREAM_INTERVAL): vol.All(
+            vol.Coerce(float), vol.Range(min=0.1)
+        ),
+        vol.Optional(
+            CONF_STREAM_IDLE_INTERVAL, default=DEFAULT_STREAM_IDLE_INTERVAL
+        ): vol.All(vol.Coerce(float), vol.Range(min=0.1)),
+        vol.Optional(CONF_RESULT_CACHE_SIZE): vol.All(
+            vol.Coerce(float), vol.Range(min=0.1)
+        ),
+        vol.Optional(
+            CONF_RESULT_CACHE_MAX_AGE, default=DEFAULT_RESULT_CACHE_MAX_AGE
+        ): vol.All(vol.Coerce(float), vol.Range(min=1)),
+        vol.Optional(CONF_DETECTOR, default=REKOGNITION): vol.In(
+            [REKOGNITION, LOCAL, CASCADE]
+        ),
+        vol.Optional(CONF_LOCAL_MODEL): cv.isfile,
+        vol.Optional(CONF_LOCAL_LABELS): cv.isfile,
+        vol.Optional(
+            CONF_CASCADE_MIN_CONFIDENCE, default=DEFAULT_CASCADE_MIN_CONFIDENCE
+        ): vol.All(vol.Coerce(float), vol.Range(min=0, max=100)),
+        vol.Optional(
+            CONF_CASCADE_MAX_CONFIDENCE, default=DEFAULT_CASCADE_MAX_CONFIDENCE
+        ): vol.All(vol.Coerce(float), vol.Range(min=0, max=100)),
         vol.Optional(CONF_BOTO_RETRIES, default=DEFAULT_BOTO_RETRIES): vol.All(
             vol.Coerce(int), vol.Range(min=0)
         ),
+        vol.Optional(CONF_MAX_POOL_CONNECTIONS): vol.All(
+            vol.Coerce(int), vol.Range(min=1)
+        ),
+        vol.Optional(
+            CONF_MAX_CONCURRENT_REQUESTS, default=DEFAULT_MAX_CONCURRENT_REQUESTS
+        ): vol.All(vol.Coerce(int), vol.Range(min=1)),
+        vol.Optional(
+            CONF_REKOGNITION_WORKERS, default=DEFAULT_REKOGNITION_WORKERS
+        ): vol.All(vol.Coerce(int), vol.Range(min=1)),
+        vol.Optional(CONF_DEDUP_MAX_DISTANCE): vol.All(
+            vol.Coerce(int), vol.Range(min=0, max=HASH_SIZE * HASH_SIZE)
+        ),
+        vol.Optional(CONF_DEDUP_TTL, default=DEFAULT_DEDUP_TTL): vol.All(
+            vol.Coerce(float), vol.Range(min=0)
+        ),
+        vol.Optional(CONF_MOTION_THRESHOLD): vol.All(
+            vol.Coerce(float), vol.Range(min=0, max=100)
+        ),
+        vol.Optional(CONF_MAX_REQUESTS_PER_SECOND): vol.All(
+            vol.Coerce(float), vol.Range(min=0.01)
+        ),
+        vol.Optional(CONF_PRIORITY, default=DEFAULT_PRIORITY): vol.Coerce(int),
+        vol.Optional(CONF_MOSAIC_WINDOW): vol.All(
+            vol.Coerce(float), vol.Range(min=0, max=10)
+        ),
+        vol.Optional(
+            CONF_MOSAIC_MAX_TILES, default=DEFAULT_MOSAIC_MAX_TILES
+        ): vol.All(vol.Coerce(int), vol.Range(min=2, max=16)),
+        vol.Optional(CONF_ATTRIBUTES, default=STANDARD): vol.In(
+            [MINIMAL, STANDARD, FULL]
+        ),
+        vol.Optional(CONF_MAX_ATTRIBUTE_ITEMS): vol.All(
+            vol.Coerce(int), vol.Range(min=0)
+        ),
+        vol.Optional(CONF_TRACKING, default=False): cv.boolean,
+        vol.Optional(CONF_TRACK_MIN_IOU, default=DEFAULT_TRACK_MIN_IOU): vol.All(
+            vol.Coerce(float), vol.Range(min=0, max=1)
+        ),
+        vol.Optional(
+            CONF_TRACK_MAX_MISSED, default=DEFAULT_TRACK_MAX_MISSED
+        ): vol.All(vol.Coerce(int), vol.Range(min=0)),
+        vol.Optional(CONF_DIAGNOSTICS, default=False): cv.boolean,
+        vol.Optional(CONF_BATCH_EVENTS, default=False): cv.boolean,
+        vol.Optional(CONF_LABEL_EVENTS): vol.All(cv.ensure_list, [cv.string]),
+        vol.Optional(CONF_LABEL_MIN_CONFIDENCE, default=0): vol.All(
+            vol.Coerce(float), vol.Range(min=0, max=100)
+        ),
+        vol.Optional(CONF_SAVE_WORKERS): vol.All(vol.Coerce(int), vol.Range(min=1)),
+        vol.Optional(CONF_SAVE_QUEUE_SIZE, default=DEFAULT_SAVE_QUEUE_SIZE): vol.All(
+            vol.Coerce(int), vol.Range(min=1)
+        ),
+        vol.Optional(CONF_SAVE_QUEUE_POLICY, default=DROP_OLDEST): vol.In(
+            [DROP_OLDEST, DROP_NEWEST, BLOCK]
+        ),
     }
 )
+PLATFORM_SCHEMA = vol.All(PLATFORM_SCHEMA, validate_detector)
 
 
 Box = namedtuple("Box", "y_min x_min y_max x_max")
@@ -157,72 +419,1606 @@ def object_in_roi(roi: dict, centroid: dict) -> bool:
     return point_in_box(roi_box, target_center_point)
 
 
-def get_objects(response: str) -> dict:
-    """Parse the data, returning detected objects only."""
-    objects = []
+class Detections:
+    """The object instances of a response, stored column-wise.
+
+    Values are rounded as in get_objects, and dicts are only built for the
+    instances that need them.
+    """
+
+    __slots__ = ("names", "confidences", "boxes", "centroids", "areas", "labels")
+
+    def __init__(self, names, confidences, boxes, centroids, areas, labels):
+        self.names = names  # lower case label name of each instance
+        self.confidences = confidences  # shape (n,)
+        self.boxes = boxes  # shape (n, 6), x_min y_min x_max y_max width height
+        self.centroids = centroids  # shape (n, 2), x y
+        self.areas = areas  # shape (n,), box area as % of frame
+        self.labels = labels  # the labels without instances, as dicts
+
+    def __len__(self):
+        return len(self.names)
+
+    def object(self, index) -> dict:
+        """Return an instance as a dict, in the format of get_objects."""
+        x_min, y_min, x_max, y_max, width, height = self.boxes[index].tolist()
+        centroid_x, centroid_y = self.centroids[index].tolist()
+        return {
+            "name": self.names[index],
+            "confidence": float(self.confidences[index]),
+            "bounding_box": {
+                "x_min": x_min,
+                "y_min": y_min,
+                "x_max": x_max,
+                "y_max": y_max,
+                "width": width,
+                "height": height,
+            },
+            "box_area": float(self.areas[index]),
+            "centroid": {"x": centroid_x, "y": centroid_y},
+        }
+
+
+def get_detections(response: dict, crop=None) -> Detections:
+    """Parse the data into Detections.
+
+    If the image sent was cropped from the frame, crop is its (x_min, y_min,
+    x_max, y_max) within the frame, and positions are mapped back to the frame.
+    """
+    names = []
+    confidences = []
+    geometry = []
     labels = []
     decimal_places = 3
 
     for label in response["Labels"]:
         if len(label["Instances"]) > 0:
+            name = label["Name"].lower()
             for instance in label["Instances"]:
-                # Extract and format instance data
                 box = instance["BoundingBox"]
-                # Get bounding box
-                x_min, y_min, width, height = (
-                    box["Left"],
-                    box["Top"],
-                    box["Width"],
-                    box["Height"],
-                )
-                x_max, y_max = x_min + width, y_min + height
-
-                bounding_box = {
-                    "x_min": round(x_min, decimal_places),
-                    "y_min": round(y_min, decimal_places),
-                    "x_max": round(x_max, decimal_places),
-                    "y_max": round(y_max, decimal_places),
-                    "width": round(box["Width"], decimal_places),
-                    "height": round(box["Height"], decimal_places),
-                }
-
-                # Get box area (% of frame)
-                box_area = width * height * 100
-
-                # Get box centroid
-                centroid_x, centroid_y = (x_min + width / 2), (y_min + height / 2)
-                centroid = {
-                    "x": round(centroid_x, decimal_places),
-                    "y": round(centroid_y, decimal_places),
-                }
-
-                objects.append(
-                    {
-                        "name": label["Name"].lower(),
-                        "confidence": round(instance["Confidence"], decimal_places),
-                        "bounding_box": bounding_box,
-                        "box_area": round(box_area, decimal_places),
-                        "centroid": centroid,
-                    }
-                )
+                names.append(name)
+                confidences.append(instance["Confidence"])
+                geometry.append((box["Left"], box["Top"], box["Width"], box["Height"]))
         else:
             label_info = {
                 "name": label["Name"].lower(),
                 "confidence": round(label["Confidence"], decimal_places),
             }
             labels.append(label_info)
-    return objects, labels
+
+    x_min, y_min, width, height = np.array(geometry, dtype=float).reshape(-1, 4).T
+    if crop:
+        crop_width, crop_height = crop[2] - crop[0], crop[3] - crop[1]
+        x_min, width = crop[0] + x_min * crop_width, width * crop_width
+        y_min, height = crop[1] + y_min * crop_height, height * crop_height
+    boxes = np.column_stack(
+        (x_min, y_min, x_min + width, y_min + height, width, height)
+    )
+    centroids = np.column_stack((x_min + width / 2, y_min + height / 2))
+    return Detections(
+        names,
+        np.round(np.array(confidences, dtype=float), decimal_places),
+        np.round(boxes, decimal_places),
+        np.round(centroids, decimal_places),
+        np.round(width * height * 100, decimal_places),
+        labels,
+    )
+
+
+def get_objects(response: str) -> dict:
+    """Parse the data, returning detected objects only."""
+    detections = get_detections(response)
+    objects = [detections.object(index) for index in range(len(detections))]
+    return objects, detections.labels
+
+
+class ZoneMap:
+    """Named polygon zones, rasterized for O(1) lookup of a point's zones.
+
+    Each cell of the grid is a bitmask of the zones which contain it. The grid
+    has the resolution of the frame, capped at ZONE_GRID_MAX_SIZE, and is
+    rebuilt when the frame size changes.
+    """
+
+    def __init__(self, zones):
+        self.names = [zone[CONF_NAME] for zone in zones]
+        self.polygons = [zone[CONF_POINTS] for zone in zones]
+        self._dtype = np.min_scalar_type(max((1 << len(zones)) - 1, 1))
+        self._size = None
+        self._grid = None
+        self._zone_names = {}  # bitmask: names
+
+    def grid(self, size) -> np.ndarray:
+        """Return the lookup grid for frames of size (width, height)."""
+        if size != self._size:
+            ratio = min(ZONE_GRID_MAX_SIZE / max(size), 1)
+            width = max(round(size[0] * ratio), 1)
+            height = max(round(size[1] * ratio), 1)
+            grid = np.zeros((height, width), dtype=self._dtype)
+            for bit, polygon in enumerate(self.polygons):
+                mask = Image.new("1", (width, height))
+                ImageDraw.Draw(mask).polygon(
+                    [(x * width, y * height) for x, y in polygon], fill=1
+                )
+                grid[np.asarray(mask)] |= self._dtype.type(1 << bit)
+            self._size, self._grid = size, grid
+        return self._grid
+
+    def lookup(self, centroids, size) -> np.ndarray:
+        """Return the zone bitmask of each (x, y) centroid."""
+        grid = self.grid(size)
+        height, width = grid.shape
+        cols = np.clip((centroids[:, 0] * width).astype(int), 0, width - 1)
+        rows = np.clip((centroids[:, 1] * height).astype(int), 0, height - 1)
+        return grid[rows, cols]
+
+    def zone_names(self, bits) -> list:
+        """Return the names of the zones in a bitmask."""
+        bits = int(bits)
+        if bits not in self._zone_names:
+            self._zone_names[bits] = [
+                name for index, name in enumerate(self.names) if bits >> index & 1
+            ]
+        return list(self._zone_names[bits])
+
+
+def dhash(image: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """Return the difference hash of an image.
+
+    Each bit records whether a pixel of the downscaled grayscale image is
+    brighter than its right hand neighbour.
+    """
+    small = image.resize((hash_size + 1, hash_size), Image.BOX).convert("L")
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    """Return the number of bits that differ between two hashes."""
+    return (hash_a ^ hash_b).bit_count()
+
+
+class FrameCache:
+    """Recent Detections keyed by the perceptual hash of the frame."""
+
+    def __init__(self, max_distance, ttl, size=DEDUP_CACHE_SIZE):
+        self._max_distance = max_distance
+        self._ttl = ttl
+        self._entries = deque(maxlen=size)  # (hash, time, result), newest last
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, frame_hash, now=None):
+        """Return the result of a similar, unexpired frame, or None."""
+        now = time.monotonic() if now is None else now
+        for entry_hash, entry_time, result in reversed(self._entries):
+            if now - entry_time > self._ttl:
+                break  # older entries have expired too
+            if hamming_distance(frame_hash, entry_hash) <= self._max_distance:
+                self.hits += 1
+                return result
+        self.misses += 1
+        return None
+
+    def put(self, frame_hash, result, now=None):
+        """Store the result for a frame."""
+        now = time.monotonic() if now is None else now
+        self._entries.append((frame_hash, now, result))
+
+
+class ResultCache:
+    """Responses stored in SQLite, keyed by a hash of the image and settings.
+
+    Unlike FrameCache this persists across restarts and is shared by every
+    entity, but only matches identical images. The least recently used
+    responses are evicted beyond max_bytes, and responses expire after
+    max_age seconds.
+    """
+
+    def __init__(self, path, max_bytes, max_age=DEFAULT_RESULT_CACHE_MAX_AGE):
+        self.max_bytes = max_bytes
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        self._connection.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS responses (
+                key BLOB PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+            """
+        )
+        self._expired = 0.0  # when expired responses were last removed
+        self._size = self._total_size()
+
+    @staticmethod
+    def key(data: bytes, *settings) -> bytes:
+        """Return the key of an image processed with the given settings."""
+        digest = hashlib.blake2b(data, digest_size=16)
+        digest.update(repr(settings).encode())
+        return digest.digest()
+
+    def _total_size(self) -> int:
+        (size,) = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        return size
+
+    def get(self, key, now=None):
+        """Return the response stored for the key, or None."""
+        now = time.time() if now is None else now
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self._max_age:
+                return None
+            self._connection.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self._connection.commit()
+        return json.loads(row[0])
+
+    def put(self, key, response, now=None):
+        """Store a response, evicting old responses if needed."""
+        now = time.time() if now is None else now
+        data = json.dumps({"Labels": response["Labels"]})
+        with self._lock:
+            old = self._connection.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now, now),
+            )
+            self._size += len(data) - (old[0] if old else 0)
+            if now - self._expired > RESULT_CACHE_EXPIRY_INTERVAL:
+                self._expired = now
+                self._connection.execute(
+                    "DELETE FROM responses WHERE created < ?", (now - self._max_age,)
+                )
+                self._size = self._total_size()
+            if self._size > self.max_bytes:
+                evicted = []
+                rows = self._connection.execute(
+                    "SELECT key, size FROM responses ORDER BY accessed"
+                )
+                for row_key, size in rows:
+                    if self._size <= self.max_bytes:
+                        break
+                    evicted.append((row_key,))
+                    self._size -= size
+                self._connection.executemany(
+                    "DELETE FROM responses WHERE key = ?", evicted
+                )
+            self._connection.commit()
+
+    def __len__(self):
+        with self._lock:
+            query = self._connection.execute("SELECT COUNT(*) FROM responses")
+            return query.fetchone()[0]
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self._connection.close()
+
+
+RESULT_CACHES = {}  # path: ResultCache
+
+
+class SnapshotArchive:
+    """Timestamped images of a folder, kept within each entity's limits.
+
+    Images are stored in a subfolder per day, and indexed in SQLite with
+    their size and creation time, so the folder is never listed. Entities
+    set their limits on the number, total size and age of their images,
+    and a background thread removes their oldest images beyond them. The
+    running totals and the index on creation time keep the cost of each
+    eviction proportional to the images removed, not to the archive.
+
+    Images of an entity saved before it had an archive are moved into the
+    day folders once, the first time it sets its limits.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._limits = {}  # name: (max_files, max_bytes, max_age)
+        self._adopt = {}  # name: suffix of images to move into day folders
+        self._lock = threading.Lock()
+        self._evicting = threading.Lock()
+        self._connection = sqlite3.connect(
+            str(self.directory / ARCHIVE_INDEX_FILE), check_same_thread=False
+        )
+        self._connection.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS images (
+                path TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS images_created ON images (name, created);
+            """
+        )
+        self._totals = {
+            name: [files, size]
+            for name, files, size in self._connection.execute(
+                "SELECT name, COUNT(*), SUM(size) FROM images GROUP BY name"
+            )
+        }
+        self.evicted = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._worker, name="rekognition_archive", daemon=True
+        )
+        self._thread.start()
+
+    def set_limits(
+        self, name, max_files=None, max_bytes=None, max_age=None, suffix=""
+    ):
+        """Set the limits of an entity's images, None for no limit.
+
+        Existing images of the entity ending with suffix are adopted.
+        """
+        with self._lock:
+            self._limits[name] = (max_files, max_bytes, max_age)
+            if name not in self._totals:
+                self._adopt[name] = suffix
+        self._wake.set()
+
+    def path(self, filename, day) -> Path:
+        """Return the path to save an image to, in the folder of its day."""
+        folder = self.directory / day
+        folder.mkdir(exist_ok=True)
+        return folder / filename
+
+    def add(self, name, path, size, created=None):
+        """Index a saved image, waking the eviction thread if over a limit."""
+        created = time.time() if created is None else created
+        path = str(Path(path).relative_to(self.directory))
+        with self._lock:
+            old = self._connection.execute(
+                "SELECT size FROM images WHERE path = ?", (path,)
+            ).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)",
+                (path, name, size, created),
+            )
+            self._connection.commit()
+            totals = self._totals.setdefault(name, [0, 0])
+            if old:
+                totals[1] += size - old[0]
+            else:
+                totals[0] += 1
+                totals[1] += size
+            max_files, max_bytes, _ = self._limits.get(name, (None, None, None))
+        if (max_files and totals[0] > max_files) or (
+            max_bytes and totals[1] > max_bytes
+        ):
+            self._wake.set()
+
+    def files(self, name) -> int:
+        """The number of images of an entity."""
+        return self._totals.get(name, (0, 0))[0]
+
+    def size(self, name) -> int:
+        """The total bytes of images of an entity."""
+        return self._totals.get(name, (0, 0))[1]
+
+    def evict(self, name, now=None) -> int:
+        """Remove the oldest images of an entity beyond its limits.
+
+        Returns: the number of images removed.
+        """
+        with self._evicting:
+            return self._evict(name, time.time() if now is None else now)
+
+    def _evict(self, name, now):
+        max_files, max_bytes, max_age = self._limits.get(name, (None, None, None))
+        oldest = now - max_age if max_age else -math.inf
+        evicted = 0
+        while True:
+            with self._lock:
+                files, size = self._totals.get(name, (0, 0))
+                rows = self._connection.execute(
+                    "SELECT path, size, created FROM images WHERE name = ? "
+                    "ORDER BY created LIMIT ?",
+                    (name, ARCHIVE_BATCH_SIZE),
+                ).fetchall()
+            removed = []
+            removed_size = 0
+            for path, image_size, created in rows:
+                if (
+                    created >= oldest
+                    and (not max_files or files <= max_files)
+                    and (not max_bytes or size <= max_bytes)
+                ):
+                    break
+                removed.append(path)
+                removed_size += image_size
+                files -= 1
+                size -= image_size
+            if not removed:
+                return evicted
+            for path in removed:
+                file_path = self.directory / path
+                file_path.unlink(missing_ok=True)
+                if file_path.parent != self.directory:
+                    with contextlib.suppress(OSError):  # not empty
+                        file_path.parent.rmdir()
+            with self._lock:
+                self._connection.executemany(
+                    "DELETE FROM images WHERE path = ?", [(path,) for path in removed]
+                )
+                self._connection.commit()
+                # Images may have been added meanwhile
+                totals = self._totals[name]
+                totals[0] -= len(removed)
+                totals[1] -= removed_size
+            evicted += len(removed)
+            self.evicted += len(removed)
+
+    def adopt(self, name, suffix):
+        """Move an entity's images saved in the folder itself into day folders."""
+        pattern = f"{glob.escape(name)}_[0-9][0-9][0-9][0-9]-*{suffix}"
+        for path in sorted(self.directory.glob(pattern)):
+            # Names of other cameras may start with this one's
+            timestamp = path.name[len(name) + 1 : len(path.name) - len(suffix)]
+            try:
+                time.strptime(timestamp, DATETIME_FORMAT)
+            except ValueError:
+                continue
+            if not path.is_file():
+                continue
+            stat = path.stat()
+            day = time.strftime("%Y-%m-%d", time.localtime(stat.st_mtime))
+            destination = self.path(path.name, day)
+            path.replace(destination)
+            self.add(name, destination, stat.st_size, stat.st_mtime)
+
+    def close(self):
+        """Finish pending evictions, then stop the thread and close the index."""
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        with self._lock:
+            self._connection.close()
+
+    def _worker(self):
+        while True:
+            self._wake.wait(ARCHIVE_INTERVAL)
+            self._wake.clear()
+            with self._lock:
+                adopt, self._adopt = self._adopt, {}
+                names = list(self._limits)
+            try:
+                for name, suffix in adopt.items():
+                    self.adopt(name, suffix)
+                for name in names:
+                    self.evict(name)
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Rekognition failed to remove old images")
+            if self._stop.is_set():
+                return
+
+
+ARCHIVES = {}  # folder: SnapshotArchive
+
+
+class FanOut:
+    """Shares work between entities watching the same camera.
+
+    The result of a call is shared with every caller asking for the same
+    key while it is in flight, and for window seconds after it completes,
+    unless run is given a window of 0.
+    """
+
+    def __init__(self, window=FAN_OUT_WINDOW):
+        self._window = window
+        self._entries = {}  # key: (future, time completed or None)
+
+    async def run(self, key, call, window=None):
+        """Return the result of call(), or of a shared call with the same key.
+
+        The result is kept for window seconds, by default the FanOut's.
+
+        Returns: (result, True if the result was shared)
+        """
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and (entry[1] is None or now - entry[1] <= self._window):
+            return await asyncio.shield(entry[0]), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._entries[key] = (future, None)
+        try:
+            result = await call()
+        except BaseException as err:
+            del self._entries[key]
+            if isinstance(err, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(err)
+                future.exception()  # the callers waiting have their own copy
+            raise
+        future.set_result(result)
+        if result is None or window == 0:
+            del self._entries[key]  # nothing worth keeping
+        else:
+            self._entries[key] = (future, time.monotonic())
+        self._expire(now)
+        return result, False
+
+    def _expire(self, now):
+        expired = [
+            key
+            for key, (_, completed) in self._entries.items()
+            if completed is not None and now - completed > self._window
+        ]
+        for key in expired:
+            del self._entries[key]
+
+
+FAN_OUT = FanOut()
+
+
+def jpeg_frames(stream, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield each JPEG in a binary stream, e.g. MJPEG or ffmpeg image2pipe."""
+    buffer = b""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        buffer += chunk
+        while True:
+            start = buffer.find(b"\xff\xd8")
+            if start < 0:
+                buffer = buffer[-1:]  # may be the first byte of a marker
+                break
+            end = buffer.find(b"\xff\xd9", start + 2)
+            if end < 0:
+                buffer = buffer[start:]
+                break
+            yield buffer[start : end + 2]
+            buffer = buffer[end + 2 :]
+        if len(buffer) > STREAM_MAX_FRAME_SIZE:
+            buffer = b""
+
+
+def ffmpeg_frames(source, fps, binary=FFMPEG_BINARY):
+    """Yield frames of an RTSP, HTTP or file source as JPEGs, decoded by ffmpeg."""
+    process = subprocess.Popen(
+        [
+            binary,
+            "-loglevel",
+            "error",
+            "-i",
+            source,
+            "-vf",
+            f"fps={fps}",
+            "-f",
+            "image2pipe",
+            "-vcodec",
+            "mjpeg",
+            "-",
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        yield from jpeg_frames(process.stdout)
+    finally:
+        process.kill()
+        process.wait()
+
+
+class StreamProcessor:
+    """Processes a continuous stream of frames for an entity.
+
+    A reader thread samples frames from the source, a decode thread
+    prepares them and a detect thread has the entity detect and publish
+    them on the event loop. Frames are sampled every interval while
+    there is motion or a recent target, and every idle_interval otherwise.
+    The queues between the threads only keep the newest frames, so memory
+    is bounded however long the stream runs and however slow the detector.
+
+    source is called to open the stream, which is reopened if it ends.
+    """
+
+    def __init__(
+        self,
+        entity,
+        source,
+        interval=DEFAULT_STREAM_INTERVAL,
+        idle_interval=DEFAULT_STREAM_IDLE_INTERVAL,
+        queue_size=STREAM_QUEUE_SIZE,
+    ):
+        self._entity = entity
+        self._source = source
+        self._interval = interval
+        self._idle_interval = idle_interval
+        self._frames = queue.Queue(maxsize=queue_size)  # encoded frames
+        self._prepared = queue.Queue(maxsize=queue_size)  # Frame to detect
+        self._stop = threading.Event()
+        self._active_until = 0.0
+        self.read = 0
+        self.sampled = 0
+        self.dropped = 0
+        self.processed = 0
+        self._threads = [
+            threading.Thread(
+                target=target, name=f"rekognition_stream_{name}", daemon=True
+            )
+            for name, target in (
+                ("read", self._read),
+                ("decode", self._decode),
+                ("detect", self._detect),
+            )
+        ]
+
+    def start(self):
+        """Start the threads."""
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stop the threads, once their current frame is done."""
+        self._stop.set()
+
+    @property
+    def interval(self) -> float:
+        """The seconds between sampled frames."""
+        if time.monotonic() < self._active_until:
+            return self._interval
+        return self._idle_interval
+
+    def activate(self):
+        """Sample frequently for a while, after motion or a target."""
+        self._active_until = time.monotonic() + STREAM_ACTIVE_TIME
+
+    def _put(self, frames, item):
+        """Queue an item, dropping the oldest item if the queue is full."""
+        while True:
+            try:
+                frames.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    frames.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def _get(self, frames):
+        """Return the next item, or None once stopped."""
+        while not self._stop.is_set():
+            try:
+                return frames.get(timeout=0.5)
+            except queue.Empty:
+                pass
+        return None
+
+    def _read(self):
+        sampled = -math.inf
+        while not self._stop.is_set():
+            try:
+                for data in self._source():
+                    if self._stop.is_set():
+                        return
+                    self.read += 1
+                    now = time.monotonic()
+                    if now - sampled >= self.interval:
+                        sampled = now
+                        self.sampled += 1
+                        self._put(self._frames, data)
+            except Exception as err:  # pylint: disable=broad-except
+                _LOGGER.warning("Rekognition stream failed: %s", err)
+            self._stop.wait(STREAM_RETRY_DELAY)
+
+    def _decode(self):
+        while True:
+            data = self._get(self._frames)
+            if data is None:
+                return
+            try:
+                frame = self._entity.prepare_image(data)
+            except UnidentifiedImageError:
+                _LOGGER.debug("Rekognition skipped a corrupt stream frame")
+                continue
+            if frame.motion:
+                if self._entity.motion_detected:
+                    self.activate()
+                self._put(self._prepared, frame)
+
+    async def _process(self, frame) -> bool:
+        # The detector is called like for a scan, so the rate limiter,
+        # fan-out and mosaic apply to stream frames too
+        response = frame.response
+        if response is None:
+            response = await self._entity.async_detect_labels(frame)
+        if response is None:
+            return False  # replaced by a newer frame while waiting
+        await self._entity.async_publish(frame, response)
+        # Nothing polls the entity in stream mode, so it writes its own state
+        self._entity.async_write_ha_state()
+        return True
+
+    def _detect(self):
+        while True:
+            frame = self._get(self._prepared)
+            if frame is None:
+                return
+            try:
+                processed = asyncio.run_coroutine_threadsafe(
+                    self._process(frame), self._entity.hass.loop
+                ).result()
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Rekognition failed to process a stream frame")
+                continue
+            if not processed:
+                self.dropped += 1
+                continue
+            self.processed += 1
+            if self._entity.state:
+                self.activate()
+
+
+class MotionGate:
+    """Scores motion within the ROI against a rolling background.
+
+    The score is the percentage of pixels of a small grayscale copy of the
+    ROI which differ from the background by more than MOTION_PIXEL_DELTA.
+    """
+
+    def __init__(self, threshold, roi):
+        self._threshold = threshold
+        self._roi = roi
+        self._background = None
+        self.score = None
+        self.motion = None
+
+    def update(self, image: Image.Image) -> bool:
+        """Score the image, update the background and return the decision."""
+        width, height = image.size
+        box = (
+            int(self._roi["x_min"] * width),
+            int(self._roi["y_min"] * height),
+            max(int(self._roi["x_max"] * width), 1),
+            max(int(self._roi["y_max"] * height), 1),
+        )
+        roi_width, roi_height = box[2] - box[0], box[3] - box[1]
+        size = (
+            MOTION_WIDTH,
+            max(round(MOTION_WIDTH * roi_height / max(roi_width, 1)), 1),
+        )
+        gray = np.asarray(
+            image.resize(size, Image.BOX, box=box).convert("L"), dtype=np.float32
+        )
+
+        if self._background is None or self._background.shape != gray.shape:
+            # Nothing to compare with, so let the frame through
+            self._background = gray
+            self.score = 100.0
+        else:
+            changed = np.abs(gray - self._background) > MOTION_PIXEL_DELTA
+            self.score = float(changed.mean() * 100)
+            self._background += MOTION_BACKGROUND_RATE * (gray - self._background)
+        self.motion = self.score >= self._threshold
+        return self.motion
+
+
+class ObjectTracker:
+    """Gives objects stable track ids across frames.
+
+    An object is matched to the track of the same name whose box overlaps it
+    most, or failing that whose centroid is close by. Tracks are kept in
+    arrays, so matching costs a few vectorised operations per frame.
+    """
+
+    def __init__(
+        self,
+        min_iou=DEFAULT_TRACK_MIN_IOU,
+        max_missed=DEFAULT_TRACK_MAX_MISSED,
+        max_distance=TRACK_MAX_CENTROID_DISTANCE,
+    ):
+        self._min_iou = min_iou
+        self._max_missed = max_missed
+        self._max_distance = max_distance
+        self.ids = np.empty(0, dtype=np.int64)
+        self.names = np.empty(0, dtype=object)
+        self.boxes = np.empty((0, 4))  # x_min y_min x_max y_max
+        self.missed = np.empty(0, dtype=np.int32)  # frames since last matched
+        self._next_id = 1
+
+    def __len__(self):
+        return len(self.ids)
+
+    def match(self, names, boxes) -> np.ndarray:
+        """Return the index of the track matching each object, or -1."""
+        matches = np.full(len(names), -1, dtype=np.int64)
+        if not len(self) or not len(names):
+            return matches
+        tracks, objects = self.boxes[:, None], boxes[None]  # broadcast to (t, o, 4)
+        overlap = np.clip(
+            np.minimum(tracks[..., 2:], objects[..., 2:])
+            - np.maximum(tracks[..., :2], objects[..., :2]),
+            0,
+            None,
+        ).prod(axis=-1)
+        track_areas = (tracks[..., 2:] - tracks[..., :2]).prod(axis=-1)
+        object_areas = (objects[..., 2:] - objects[..., :2]).prod(axis=-1)
+        iou = overlap / np.maximum(track_areas + object_areas - overlap, 1e-9)
+        track_centers = (tracks[..., :2] + tracks[..., 2:]) / 2
+        object_centers = (objects[..., :2] + objects[..., 2:]) / 2
+        distance = np.linalg.norm(track_centers - object_centers, axis=-1)
+
+        same_name = self.names[:, None] == np.array(names, dtype=object)[None]
+        candidates = same_name & (
+            (iou >= self._min_iou) | (distance <= self._max_distance)
+        )
+        track_index, object_index = np.nonzero(candidates)
+        # Greedily take the best overlap first, then the nearest
+        order = np.lexsort(
+            (distance[track_index, object_index], -iou[track_index, object_index])
+        )
+        matched = set()
+        for track, obj in zip(
+            track_index[order].tolist(), object_index[order].tolist()
+        ):
+            if track not in matched and matches[obj] < 0:
+                matched.add(track)
+                matches[obj] = track
+        return matches
+
+    def update(self, names, boxes):
+        """Match the objects of a frame to the tracks.
+
+        Returns: the track id of each object, a mask of the objects which
+        started a track, and the (track id, name) of departed tracks.
+        """
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        matches = self.match(names, boxes)
+        found = matches >= 0
+        new = ~found
+
+        missed = self.missed + 1
+        missed[matches[found]] = 0
+        self.boxes[matches[found]] = boxes[found]
+        keep = missed <= self._max_missed
+        departed = list(zip(self.ids[~keep].tolist(), self.names[~keep].tolist()))
+
+        ids = np.empty(len(names), dtype=np.int64)
+        ids[found] = self.ids[matches[found]]
+        ids[new] = np.arange(self._next_id, self._next_id + new.sum())
+        self._next_id += int(new.sum())
+
+        self.ids = np.concatenate((self.ids[keep], ids[new]))
+        self.names = np.concatenate(
+            (self.names[keep], np.array(names, dtype=object)[new])
+        )
+        self.boxes = np.concatenate((self.boxes[keep], boxes[new]))
+        self.missed = np.concatenate(
+            (missed[keep], np.zeros(new.sum(), dtype=np.int32))
+        )
+        return ids, new, departed
+
+
+class Frame:
+    """A camera frame moving through the processing stages."""
+
+    def __init__(self, data, image=None):
+        self.data = data  # the encoded bytes sent to Rekognition
+        self._image = image
+        self.hash = None  # the perceptual hash, when deduplication is enabled
+        self.motion = True  # False when the motion gate holds the frame back
+        self.crop = None  # (x_min, y_min, x_max, y_max) of the data, if cropped
+        self.cache_key = None  # the key in the result cache, if enabled
+        self.response = None  # the response from the result cache, if found
+
+    @property
+    def image(self) -> Image.Image:
+        """The image, which is only opened when first used.
+
+        Opening reads just the header, the pixels are decoded on first access.
+        """
+        if self._image is None:
+            self._image = Image.open(io.BytesIO(self.data))
+        return self._image
+
+    @property
+    def size(self):
+        """The width and height, from the header if not yet decoded."""
+        return self.image.size
+
+
+class SaveQueue:
+    """Bounded queue of images to save, written by worker threads.
+
+    When the queue is full, the policy either drops the oldest queued image,
+    drops the new image, or blocks the caller until there is space.
+    """
+
+    def __init__(self, workers, size, policy):
+        self._queue = queue.Queue(maxsize=size)
+        self._policy = policy
+        self._threads = [
+            threading.Thread(
+                target=self._worker, name=f"rekognition_save_{index}", daemon=True
+            )
+            for index in range(workers)
+        ]
+        self.dropped = 0
+        self.latency = None  # seconds taken by the last save
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def depth(self) -> int:
+        """The number of images waiting to be saved."""
+        return self._queue.qsize()
+
+    @property
+    def blocking(self) -> bool:
+        """True if submit may block."""
+        return self._policy == BLOCK
+
+    def submit(self, job, callback=None) -> bool:
+        """Queue job, calling callback with its result once done.
+
+        Returns: False if the job was dropped.
+        """
+        if self._policy == BLOCK:
+            self._queue.put((job, callback))
+            return True
+        try:
+            self._queue.put_nowait((job, callback))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            if self._policy == DROP_NEWEST:
+                return False
+        try:
+            self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self._queue.put_nowait((job, callback))
+        except queue.Full:
+            return False
+        return True
+
+    def shutdown(self):
+        """Stop the workers once the queued images are saved."""
+        for _ in self._threads:
+            self._queue.put((None, None))
+
+    def _worker(self):
+        while True:
+            job, callback = self._queue.get()
+            if job is None:
+                return
+            start = time.monotonic()
+            try:
+                result = job()
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Rekognition failed to save image")
+                continue
+            self.latency = time.monotonic() - start
+            if callback and result:
+                callback(result)
+
+
+@functools.lru_cache(maxsize=None)
+def get_transfer_config():
+    """Return the S3 transfer configuration shared by all uploads."""
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=S3_MULTIPART_THRESHOLD,
+        max_concurrency=S3_MAX_CONCURRENCY,
+    )
+
+
+def upload_bytes(s3_client, data: bytes, bucket: str, key: str):
+    """Upload data to S3 from memory, using multipart uploads for large data."""
+    if len(data) < S3_MULTIPART_THRESHOLD:
+        s3_client.put_object(Body=data, Bucket=bucket, Key=key)
+    else:
+        with io.BytesIO(data) as fileobj:
+            s3_client.upload_fileobj(
+                fileobj, Bucket=bucket, Key=key, Config=get_transfer_config()
+            )
+
+
+class Histogram:
+    """Latency histogram with Prometheus style buckets."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Record a value, in seconds."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q) -> float:
+        """Estimate a quantile, interpolating within its bucket."""
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                if index == len(self.buckets):
+                    return lower  # +Inf bucket, all we know is the lower bound
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return 0.0
+
+
+METRICS_LISTENERS = []
+
+
+def add_metrics_listener(listener):
+    """Add a listener called as listener(entity_id, metric, value).
+
+    Metrics are "<stage>_seconds" timings, and the counters "api_calls",
+    "bytes_sent", "bytes_uploaded" and "errors" with their increment. Only
+    entities with diagnostics enabled report metrics.
+
+    Returns: a function removing the listener.
+    """
+    METRICS_LISTENERS.append(listener)
+    return lambda: METRICS_LISTENERS.remove(listener)
+
+
+class Metrics:
+    """Per stage latency histograms and counters of an entity."""
+
+    def __init__(self):
+        self.stages = {}  # stage: Histogram
+        self.counters = Counter()
+
+    def observe(self, entity_id, stage, seconds):
+        """Record the time taken by a stage."""
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.observe(seconds)
+        for listener in METRICS_LISTENERS:
+            listener(entity_id, f"{stage}_seconds", seconds)
+
+    def increment(self, entity_id, counter, value=1):
+        """Add to a counter."""
+        self.counters[counter] += value
+        for listener in METRICS_LISTENERS:
+            listener(entity_id, counter, value)
+
+    @contextlib.contextmanager
+    def measure(self, entity_id, stage):
+        """Time the block as a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(entity_id, stage, time.perf_counter() - start)
+
+    def as_dict(self) -> dict:
+        """Return a summary, with latencies in ms."""
+        latency = {
+            stage: {
+                "count": histogram.count,
+                "mean": round(histogram.sum / histogram.count * 1000, 2),
+                "p50": round(histogram.quantile(0.5) * 1000, 2),
+                "p99": round(histogram.quantile(0.99) * 1000, 2),
+            }
+            for stage, histogram in self.stages.items()
+        }
+        return {"latency_ms": latency, **self.counters}
+
+
+NOT_MEASURED = contextlib.nullcontext()
+
+
+def is_throttling_error(err: Exception) -> bool:
+    """Return True if err is Rekognition refusing a request over the TPS limit."""
+    code = getattr(err, "response", {}).get("Error", {}).get("Code")
+    return code in THROTTLING_ERRORS
+
+
+class RateLimiter:
+    """Token bucket in front of Rekognition, shared by all entities of an account.
+
+    The rate halves whenever a request is throttled, and recovers gradually
+    with each success. Requests waiting for a token are granted by priority,
+    then to the key (entity) served least recently. A key has at most one
+    waiting request, a newer one replaces it.
+    """
+
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._waiting = {}  # key: (priority, time queued, future)
+        self._served = {}  # key: time last granted
+        self._timer = None
+        self.throttles = 0
+        self.dropped = 0
+        self.wait_time = 0.0  # seconds the last granted request waited
+
+    async def acquire(self, key, priority=DEFAULT_PRIORITY) -> bool:
+        """Wait for a token.
+
+        Returns: False if a newer request with the same key replaced this one.
+        """
+        previous = self._waiting.pop(key, None)
+        if previous and not previous[2].done():
+            self.dropped += 1
+            previous[2].set_result(False)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[key] = (priority, time.monotonic(), future)
+        self._grant()
+        return await future
+
+    async def run(self, key, priority, call):
+        """Await call() once a token is granted, retrying if throttled.
+
+        Retries wait for a random time up to THROTTLE_BACKOFF, doubled for
+        each retry.
+
+        Returns: the result, or None if a newer request with the key replaced it.
+        """
+        attempt = 0
+        while True:
+            if not await self.acquire(key, priority):
+                return None
+            try:
+                result = await call()
+            except Exception as err:
+                if attempt >= THROTTLE_RETRIES or not is_throttling_error(err):
+                    raise
+                self.throttled()
+                _LOGGER.debug("Rekognition throttled, rate now %.2f/s", self.rate)
+                await asyncio.sleep(random.uniform(0, THROTTLE_BACKOFF * 2 ** attempt))
+                attempt += 1
+                continue
+            self.succeeded()
+            return result
+
+    def throttled(self):
+        """Slow down after a throttled request."""
+        self.throttles += 1
+        self.rate = max(self.rate * RATE_DECREASE, self.max_rate * MIN_RATE_FRACTION)
+        # No tokens are earned for the time spent on the throttled call
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+
+    def succeeded(self):
+        """Speed up again after a successful request."""
+        self.rate = min(self.rate + self.max_rate * RATE_INCREASE, self.max_rate)
+
+    def _timer_fired(self):
+        self._timer = None
+        self._grant()
+
+    def _grant(self):
+        now = time.monotonic()
+        # Up to a second's worth of requests may be made at once
+        capacity = max(self.max_rate, 1.0)
+        self._tokens = min(self._tokens + (now - self._updated) * self.rate, capacity)
+        self._updated = now
+        for key in [key for key, value in self._waiting.items() if value[2].done()]:
+            del self._waiting[key]  # cancelled
+        while self._waiting and self._tokens >= 1:
+            key = min(
+                self._waiting,
+                key=lambda key: (
+                    -self._waiting[key][0],
+                    self._served.get(key, 0),
+                    self._waiting[key][1],
+                ),
+            )
+            _, queued, future = self._waiting.pop(key)
+            self._tokens -= 1
+            self._served[key] = now
+            self.wait_time = now - queued
+            future.set_result(True)
+        if self._waiting and self._timer is None:
+            delay = (1 - self._tokens) / self.rate
+            self._timer = asyncio.get_running_loop().call_later(
+                delay, self._timer_fired
+            )
+
+
+RATE_LIMITERS = {}  # (region, access key id): RateLimiter
+
+
+def compose_mosaic(
+    images, tile_size=MOSAIC_TILE_SIZE, quality=DEFAULT_JPEG_QUALITY
+):
+    """Tile the encoded images into one JPEG, on a grid as square as possible.
+
+    Each image is fitted into a tile, keeping its aspect ratio.
+
+    Returns: the mosaic, and the (x_min, y_min, x_max, y_max) of each image
+    within it.
+    """
+    cols = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / cols)
+    tile_width, tile_height = tile_size
+    width, height = cols * tile_width, rows * tile_height
+    mosaic = Image.new("RGB", (width, height))
+    tiles = []
+    for index, data in enumerate(images):
+        image = Image.open(io.BytesIO(data))
+        image.draft("RGB", tile_size)
+        image = image.convert("RGB")
+        image.thumbnail(tile_size, Image.BILINEAR)
+        left = (index % cols) * tile_width
+        top = (index // cols) * tile_height
+        mosaic.paste(image, (left, top))
+        tiles.append(
+            (
+                left / width,
+                top / height,
+                (left + image.width) / width,
+                (top + image.height) / height,
+            )
+        )
+    with io.BytesIO() as output:
+        mosaic.save(output, format="JPEG", quality=quality)
+        return output.getvalue(), tiles
+
+
+def split_mosaic_response(response: dict, tiles) -> list:
+    """Split a response for a mosaic into a response for each tile.
+
+    Instances go to the tile containing their centroid, with the bounding box
+    clipped to the tile and relative to it. Labels without instances can't be
+    placed, so they are given to every tile.
+    """
+    responses = [{"Labels": []} for _ in tiles]
+    for label in response["Labels"]:
+        if len(label["Instances"]) == 0:
+            for tile_response in responses:
+                tile_response["Labels"].append(label)
+            continue
+        tile_instances = [[] for _ in tiles]
+        for instance in label["Instances"]:
+            box = instance["BoundingBox"]
+            left, top = box["Left"], box["Top"]
+            right, bottom = left + box["Width"], top + box["Height"]
+            centroid_x, centroid_y = (left + right) / 2, (top + bottom) / 2
+            for index, (x_min, y_min, x_max, y_max) in enumerate(tiles):
+                if x_min <= centroid_x < x_max and y_min <= centroid_y < y_max:
+                    tile_width, tile_height = x_max - x_min, y_max - y_min
+                    left, top = max(left, x_min), max(top, y_min)
+                    right, bottom = min(right, x_max), min(bottom, y_max)
+                    bounding_box = {
+                        "Width": (right - left) / tile_width,
+                        "Height": (bottom - top) / tile_height,
+                        "Left": (left - x_min) / tile_width,
+                        "Top": (top - y_min) / tile_height,
+                    }
+                    tile_instances[index].append(
+                        {**instance, "BoundingBox": bounding_box}
+                    )
+                    break
+        for tile_response, instances in zip(responses, tile_instances):
+            if instances:
+                tile_response["Labels"].append({**label, "Instances": instances})
+    return responses
+
+
+class MosaicBatcher:
+    """Batches frames from several cameras into one Rekognition call.
+
+    Frames arriving within window seconds of the first, up to max_tiles, are
+    tiled into a mosaic. The response is split back to each frame.
+    """
+
+    def __init__(self, hass, client, executor, window, max_tiles, quality):
+        self._hass = hass
+        self._client = client
+        self._executor = executor
+        self._window = window
+        self._max_tiles = max_tiles
+        self._quality = quality
+        self._pending = []  # (frame, future)
+        self._timer = None
+        self.requests = 0
+        self.frames = 0
+
+    async def detect_labels(self, frame) -> dict:
+        """Return the response for the frame, once its batch has been sent."""
+        future = self._hass.loop.create_future()
+        self._pending.append((frame, future))
+        if len(self._pending) >= self._max_tiles:
+            self._flush()
+        elif self._timer is None:
+            self._timer = self._hass.loop.call_later(self._window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        self._hass.loop.create_task(self._detect_batch(batch))
+
+    async def _detect_batch(self, batch):
+        try:
+            responses = await self._hass.loop.run_in_executor(
+                self._executor, self._detect, [frame.data for frame, _ in batch]
+            )
+        except Exception as err:  # pylint: disable=broad-except
+            for _, future in batch:
+                if not future.done():  # cancelled
+                    future.set_exception(err)
+            return
+        for (_, future), response in zip(batch, responses):
+            if not future.done():
+                future.set_result(response)
+
+    def _detect(self, images) -> list:
+        self.requests += 1
+        self.frames += len(images)
+        if len(images) == 1:
+            return [self._client.detect_labels(Image={"Bytes": images[0]})]
+        mosaic, tiles = compose_mosaic(images, quality=self._quality)
+        response = self._client.detect_labels(Image={"Bytes": mosaic})
+        return split_mosaic_response(response, tiles)
 
 
 def get_valid_filename(name: str) -> str:
     return re.sub(r"(?u)[^-\w.]", "", str(name).strip().replace(" ", "_"))
 
 
+class ClientRegistry:
+    """boto3 clients shared by every platform using the same credentials.
+
+    Platforms reserve connections at setup, and the client is only created
+    on first use, which happens in a worker thread rather than during the
+    Home Assistant startup. Its connection pool is sized for all of the
+    reservations made by then.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._connections = Counter()
+        self._retries = {}
+
+    def reserve(self, service, aws_config, connections, retries=DEFAULT_BOTO_RETRIES):
+        """Return a SharedClient for the service and reserve pool connections."""
+        key = (
+            service,
+            aws_config[CONF_REGION],
+            aws_config[CONF_ACCESS_KEY_ID],
+            aws_config[CONF_SECRET_ACCESS_KEY],
+        )
+        with self._lock:
+            self._connections[key] += connections
+            self._retries[key] = max(retries, self._retries.get(key, 0))
+        return SharedClient(self, key)
+
+    def get(self, key):
+        """Return the client for the key, creating it if required."""
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._create(key)
+                self._clients[key] = client
+            return client
+
+    def _create(self, key):
+        import boto3
+        from botocore.config import Config
+
+        service, region, access_key_id, secret_access_key = key
+        pool_size = max(self._connections[key], DEFAULT_MAX_POOL_CONNECTIONS)
+        _LOGGER.debug(
+            "Creating boto3 %s client with %s pool connections", service, pool_size
+        )
+        # A session per client, as the default session is not thread safe
+        session = boto3.session.Session(
+            region_name=region,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key,
+        )
+
+        retries = 0
+        while retries <= self._retries[key]:
+            try:
+                return session.client(
+                    service, config=Config(max_pool_connections=pool_size)
+                )
+            except KeyError:
+                _LOGGER.info("boto3 client failed, retries={}".format(retries))
+                retries += 1
+                time.sleep(1)
+
+        raise Exception(
+            "Failed to create boto3 client. Maybe try increasing "
+            "the boto_retries setting. Retry counter was {}".format(retries)
+        )
+
+
+class SharedClient:
+    """Stands in for a boto3 client, which is created on first use."""
+
+    def __init__(self, registry, key):
+        self._registry = registry
+        self._key = key
+
+    def __getattr__(self, name):
+        return getattr(self._registry.get(self._key), name)
+
+
+CLIENT_REGISTRY = ClientRegistry()
+
+
+def local_response(
+    boxes, classes, scores, labels, min_confidence=LOCAL_MIN_CONFIDENCE
+):
+    """Return the output of a local model as a Rekognition response.
+
+    Args:
+        boxes: shape (n, 4), y_min x_min y_max x_max relative to the image.
+        classes: shape (n,), the class id of each box, indexing labels.
+        scores: shape (n,), in the range 0-1.
+    """
+    instances = {}
+    for box, class_id, score in zip(
+        np.asarray(boxes).tolist(), np.asarray(classes).tolist(), np.asarray(scores)
+    ):
+        confidence = float(score) * 100
+        class_id = int(class_id)
+        if confidence < min_confidence or not 0 <= class_id < len(labels):
+            continue
+        y_min, x_min, y_max, x_max = box
+        instances.setdefault(labels[class_id], []).append(
+            {
+                "BoundingBox": {
+                    "Width": x_max - x_min,
+                    "Height": y_max - y_min,
+                    "Left": x_min,
+                    "Top": y_min,
+                },
+                "Confidence": confidence,
+            }
+        )
+    return {
+        "Labels": [
+            {
+                "Name": name,
+                "Confidence": max(instance["Confidence"] for instance in found),
+                "Instances": found,
+                "Parents": [],
+            }
+            for name, found in instances.items()
+        ]
+    }
+
+
+class LocalDetector:
+    """Runs an object detection model on the CPU with ONNX Runtime.
+
+    The model takes a batch of one uint8 RGB image, and outputs the boxes
+    (y_min, x_min, y_max, x_max relative to the image), class ids and scores
+    of its detections, as models exported with the TensorFlow object
+    detection API do. It has the detect_labels method of the Rekognition
+    client, so it can stand in for it.
+    """
+
+    def __init__(self, model_path, labels, session=None):
+        self._model_path = model_path
+        self._labels = labels
+        self._session = session
+        self._lock = threading.Lock()
+        # Identifies the model's results in the result cache
+        self.cache_id = (LOCAL, str(model_path), tuple(labels))
+
+    @property
+    def session(self):
+        """The inference session, which is loaded on first use."""
+        with self._lock:
+            if self._session is None:
+                import onnxruntime  # pylint: disable=import-outside-toplevel
+
+                _LOGGER.info("Loading local model %s", self._model_path)
+                self._session = onnxruntime.InferenceSession(
+                    str(self._model_path), providers=["CPUExecutionProvider"]
+                )
+            return self._session
+
+    def detect_labels(self, **request):
+        """Detect objects in an image, taking and returning Rekognition's format."""
+        session = self.session
+        model_input = session.get_inputs()[0]
+        image = Image.open(io.BytesIO(request["Image"]["Bytes"])).convert("RGB")
+        height, width = model_input.shape[1:3]
+        if isinstance(height, int) and isinstance(width, int):
+            image = image.resize((width, height), Image.BILINEAR)
+        pixels = np.asarray(image, dtype=np.uint8)[None]
+        outputs = session.run(None, {model_input.name: pixels})
+        named = dict(zip([output.name for output in session.get_outputs()], outputs))
+        boxes = named.get("detection_boxes", outputs[0])
+        classes = named.get("detection_classes", outputs[1])
+        scores = named.get("detection_scores", outputs[2])
+        return local_response(boxes[0], classes[0], scores[0], self._labels)
+
+
+class CascadeDetector:
+    """Runs a local detector first, and Rekognition only when it is unsure.
+
+    The local result is used unless a target has a local confidence in the
+    uncertain band [min_confidence, max_confidence), in which case the
+    frame is escalated to Rekognition.
+    """
+
+    def __init__(self, local, remote, targets, min_confidence, max_confidence):
+        self._local = local
+        self._remote = remote
+        self._targets = set(targets)
+        self._min_confidence = min_confidence
+        self._max_confidence = max_confidence
+        self.cache_id = (
+            CASCADE,
+            local.cache_id,
+            tuple(sorted(self._targets)),
+            min_confidence,
+            max_confidence,
+        )
+        self.local_results = 0
+        self.escalations = 0
+
+    def uncertain(self, response) -> bool:
+        """Return True if any target in the response is in the uncertain band."""
+        return any(
+            self._min_confidence <= instance["Confidence"] < self._max_confidence
+            for label in response["Labels"]
+            if label["Name"].lower() in self._targets
+            for instance in label["Instances"]
+        )
+
+    def detect_labels(self, **request):
+        """Detect objects locally, escalating uncertain frames."""
+        response = self._local.detect_labels(**request)
+        if self.uncertain(response):
+            self.escalations += 1
+            return self._remote.detect_labels(**request)
+        self.local_results += 1
+        return response
+
+
+def read_labels(path) -> list:
+    """Return the labels of a local model, one per line, line N is class id N."""
+    return [line.strip().lower() for line in Path(path).read_text().splitlines()]
+
+
 def setup_platform(hass, config, add_devices, discovery_info=None):
     """Set up ObjectDetection."""
 
-    import boto3
-
     _LOGGER.debug("boto_retries setting is {}".format(config[CONF_BOTO_RETRIES]))
 
     aws_config = {
@@ -231,26 +2027,46 @@ def setup_platform(hass, config, add_devices, discovery_info=None):
         CONF_SECRET_ACCESS_KEY: config[CONF_SECRET_ACCESS_KEY],
     }
 
-    retries = 0
-    success = False
-    while retries <= config[CONF_BOTO_RETRIES]:
-        try:
-            rekognition_client = boto3.client("rekognition", **aws_config)
-            success = True
-            break
-        except KeyError:
-            _LOGGER.info("boto3 client failed, retries={}".format(retries))
-            retries += 1
-            time.sleep(1)
-
-    if not success:
-        raise Exception(
-            "Failed to create boto3 client. Maybe try increasing "
-            "the boto_retries setting. Retry counter was {}".format(retries)
+    connections = config.get(CONF_MAX_POOL_CONNECTIONS)
+    if connections is None:
+        connections = len(config[CONF_SOURCE]) * config[CONF_MAX_CONCURRENT_REQUESTS]
+    rekognition_client = CLIENT_REGISTRY.reserve(
+        "rekognition", aws_config, connections, config[CONF_BOTO_RETRIES]
+    )
+
+    detector = rekognition_client
+    if config[CONF_DETECTOR] != REKOGNITION:
+        detector = LocalDetector(
+            config[CONF_LOCAL_MODEL], read_labels(config[CONF_LOCAL_LABELS])
         )
+        if config[CONF_DETECTOR] == CASCADE:
+            detector = CascadeDetector(
+                detector,
+                rekognition_client,
+                [target[CONF_TARGET] for target in config[CONF_TARGETS]],
+                config[CONF_CASCADE_MIN_CONFIDENCE],
+                config[CONF_CASCADE_MAX_CONFIDENCE],
+            )
+
+    result_cache = None
+    if config.get(CONF_RESULT_CACHE_SIZE):
+        path = hass.config.path(RESULT_CACHE_FILE)
+        max_bytes = int(config[CONF_RESULT_CACHE_SIZE] * 1024 * 1024)
+        result_cache = RESULT_CACHES.get(path)
+        if result_cache is None:
+            result_cache = RESULT_CACHES[path] = ResultCache(
+                path, max_bytes, config[CONF_RESULT_CACHE_MAX_AGE]
+            )
+            hass.bus.listen_once(
+                EVENT_HOMEASSISTANT_STOP, lambda event: result_cache.close()
+            )
+        # Platforms share one database, which gets the largest size configured
+        result_cache.max_bytes = max(result_cache.max_bytes, max_bytes)
 
     if config.get(CONF_S3_BUCKET):
-        s3_client = boto3.client("s3", **aws_config)
+        s3_client = CLIENT_REGISTRY.reserve(
+            "s3", aws_config, connections, config[CONF_BOTO_RETRIES]
+        )
     else:
         s3_client = None
 
@@ -258,11 +2074,67 @@ def setup_platform(hass, config, add_devices, discovery_info=None):
     if save_file_folder:
         save_file_folder = Path(save_file_folder)
 
+    archive = None
+    retention = (CONF_SAVE_MAX_FILES, CONF_SAVE_MAX_SIZE, CONF_SAVE_MAX_AGE)
+    if (
+        save_file_folder
+        and config.get(CONF_SAVE_TIMESTAMPTED_FILE)
+        and any(config.get(option) for option in retention)
+    ):
+        archive = ARCHIVES.get(save_file_folder)
+        if archive is None:
+            archive = ARCHIVES[save_file_folder] = SnapshotArchive(save_file_folder)
+            hass.bus.listen_once(
+                EVENT_HOMEASSISTANT_STOP, lambda event: archive.close()
+            )
+
+    # Dedicated pool for the blocking Rekognition round trips, so that they
+    # don't hold threads of the Home Assistant executor.
+    executor = ThreadPoolExecutor(
+        max_workers=config[CONF_REKOGNITION_WORKERS],
+        thread_name_prefix="rekognition",
+    )
+    hass.bus.listen_once(
+        EVENT_HOMEASSISTANT_STOP, lambda event: executor.shutdown(wait=False)
+    )
+
+    rate_limiter = None
+    if config.get(CONF_MAX_REQUESTS_PER_SECOND):
+        rate = config[CONF_MAX_REQUESTS_PER_SECOND]
+        rate_limiter = RATE_LIMITERS.setdefault(
+            (config[CONF_REGION], config[CONF_ACCESS_KEY_ID]), RateLimiter(rate)
+        )
+        # Platforms sharing an account get the lowest rate configured
+        rate_limiter.max_rate = min(rate_limiter.max_rate, rate)
+        rate_limiter.rate = min(rate_limiter.rate, rate)
+
+    mosaic = None
+    if config.get(CONF_MOSAIC_WINDOW) is not None:
+        mosaic = MosaicBatcher(
+            hass,
+            detector,
+            executor,
+            config[CONF_MOSAIC_WINDOW],
+            config[CONF_MOSAIC_MAX_TILES],
+            config[CONF_JPEG_QUALITY],
+        )
+
+    save_queue = None
+    if (save_file_folder or s3_client) and config.get(CONF_SAVE_WORKERS):
+        save_queue = SaveQueue(
+            config[CONF_SAVE_WORKERS],
+            config[CONF_SAVE_QUEUE_SIZE],
+            config[CONF_SAVE_QUEUE_POLICY],
+        )
+        hass.bus.listen_once(
+            EVENT_HOMEASSISTANT_STOP, lambda event: save_queue.shutdown()
+        )
+
     entities = []
     for camera in config[CONF_SOURCE]:
         entities.append(
             ObjectDetection(
-                rekognition_client=rekognition_client,
+                rekognition_client=detector,
                 s3_client=s3_client,
                 region=config.get(CONF_REGION),
                 targets=config.get(CONF_TARGETS),
@@ -271,8 +2143,27 @@ def setup_platform(hass, config, add_devices, discovery_info=None):
                 roi_x_min=config[CONF_ROI_X_MIN],
                 roi_y_max=config[CONF_ROI_Y_MAX],
                 roi_x_max=config[CONF_ROI_X_MAX],
+                zones=config[CONF_ZONES],
+                roi_crop=config[CONF_ROI_CROP],
+                roi_crop_margin=config[CONF_ROI_CROP_MARGIN],
+                mosaic=mosaic,
+                rate_limiter=rate_limiter,
+                diagnostics=config[CONF_DIAGNOSTICS],
+                batch_events=config[CONF_BATCH_EVENTS],
+                label_events=config.get(CONF_LABEL_EVENTS),
+                label_min_confidence=config[CONF_LABEL_MIN_CONFIDENCE],
+                attributes=config[CONF_ATTRIBUTES],
+                max_attribute_items=config.get(CONF_MAX_ATTRIBUTE_ITEMS),
+                tracking=config[CONF_TRACKING],
+                track_min_iou=config[CONF_TRACK_MIN_IOU],
+                track_max_missed=config[CONF_TRACK_MAX_MISSED],
+                priority=config[CONF_PRIORITY],
                 scale=config[CONF_SCALE],
+                jpeg_quality=config[CONF_JPEG_QUALITY],
                 show_boxes=config[CONF_SHOW_BOXES],
+                save_quality=config[CONF_SAVE_QUALITY],
+                save_optimize=config[CONF_SAVE_OPTIMIZE],
+                save_progressive=config[CONF_SAVE_PROGRESSIVE],
                 save_file_format=config[CONF_SAVE_FILE_FORMAT],
                 save_file_folder=save_file_folder,
                 save_timestamped_file=config.get(CONF_SAVE_TIMESTAMPTED_FILE),
@@ -280,6 +2171,21 @@ def setup_platform(hass, config, add_devices, discovery_info=None):
                 s3_bucket=config.get(CONF_S3_BUCKET),
                 camera_entity=camera.get(CONF_ENTITY_ID),
                 name=camera.get(CONF_NAME),
+                executor=executor,
+                max_concurrent_requests=config[CONF_MAX_CONCURRENT_REQUESTS],
+                dedup_max_distance=config.get(CONF_DEDUP_MAX_DISTANCE),
+                dedup_ttl=config[CONF_DEDUP_TTL],
+                motion_threshold=config.get(CONF_MOTION_THRESHOLD),
+                save_queue=save_queue,
+                result_cache=result_cache,
+                archive=archive,
+                save_max_files=config.get(CONF_SAVE_MAX_FILES),
+                save_max_size=config.get(CONF_SAVE_MAX_SIZE),
+                save_max_age=config.get(CONF_SAVE_MAX_AGE),
+                fan_out=FAN_OUT if config[CONF_SHARE_CAMERA] else None,
+                stream=config[CONF_STREAM],
+                stream_interval=config[CONF_STREAM_INTERVAL],
+                stream_idle_interval=config[CONF_STREAM_IDLE_INTERVAL],
             )
         )
     add_devices(entities)
@@ -308,6 +2214,40 @@ class ObjectDetection(ImageProcessingEntity):
         s3_bucket,
         camera_entity,
         name=None,
+        executor=None,
+        max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS,
+        dedup_max_distance=None,
+        dedup_ttl=DEFAULT_DEDUP_TTL,
+        motion_threshold=None,
+        jpeg_quality=DEFAULT_JPEG_QUALITY,
+        save_queue=None,
+        zones=None,
+        roi_crop=False,
+        roi_crop_margin=DEFAULT_ROI_CROP_MARGIN,
+        mosaic=None,
+        rate_limiter=None,
+        priority=DEFAULT_PRIORITY,
+        diagnostics=False,
+        batch_events=False,
+        label_events=None,
+        label_min_confidence=0,
+        attributes=STANDARD,
+        max_attribute_items=None,
+        tracking=False,
+        track_min_iou=DEFAULT_TRACK_MIN_IOU,
+        track_max_missed=DEFAULT_TRACK_MAX_MISSED,
+        save_quality=DEFAULT_SAVE_QUALITY,
+        save_optimize=False,
+        save_progressive=False,
+        result_cache=None,
+        archive=None,
+        save_max_files=None,
+        save_max_size=None,
+        save_max_age=None,
+        fan_out=None,
+        stream=False,
+        stream_interval=DEFAULT_STREAM_INTERVAL,
+        stream_idle_interval=DEFAULT_STREAM_IDLE_INTERVAL,
     ):
         """Init with the client."""
         self._aws_rekognition_client = rekognition_client
@@ -319,6 +2259,9 @@ class ObjectDetection(ImageProcessingEntity):
             if CONF_CONFIDENCE not in target.keys():
                 target.update({CONF_CONFIDENCE: self._confidence})
         self._targets_names = [target[CONF_TARGET] for target in targets]
+        self._targets_confidences = {
+            target[CONF_TARGET]: target[CONF_CONFIDENCE] for target in targets
+        }
         self._summary = {target: 0 for target in self._targets_names}
 
         self._camera_entity = camera_entity
@@ -330,7 +2273,7 @@ class ObjectDetection(ImageProcessingEntity):
 
         self._state = None  # The number of instances of interest
         self._last_detection = None  # The last time we detected a target
-        self._objects = []  # The parsed raw data
+        self._detections = get_detections({"Labels": []})  # The parsed raw data
         self._labels = []  # The parsed raw data
         self._targets_found = []  # The filtered targets data
 
@@ -340,7 +2283,17 @@ class ObjectDetection(ImageProcessingEntity):
             "y_max": roi_y_max,
             "x_max": roi_x_max,
         }
+        self._zone_map = ZoneMap(zones) if zones else None
+        self._crop = None
+        if roi_crop and tuple(self._roi_dict.values()) != DEFAULT_ROI:
+            self._crop = (
+                max(roi_x_min - roi_crop_margin, 0.0),
+                max(roi_y_min - roi_crop_margin, 0.0),
+                min(roi_x_max + roi_crop_margin, 1.0),
+                min(roi_y_max + roi_crop_margin, 1.0),
+            )
         self._scale = scale
+        self._jpeg_quality = jpeg_quality
         self._show_boxes = show_boxes
         self._last_detection = None
         self._image_width = None
@@ -349,51 +2302,454 @@ class ObjectDetection(ImageProcessingEntity):
         self._save_file_folder = save_file_folder
         self._save_timestamped_file = save_timestamped_file
         self._always_save_latest_file = always_save_latest_file
+        self._save_options = {"optimize": save_optimize}
+        if self._save_file_format == JPG:
+            self._save_options.update(
+                quality=save_quality, progressive=save_progressive
+            )
         self._s3_bucket = s3_bucket
-        self._image = None
+        self._frame = None  # the last processed frame, used for saving
+        self._save_queue = save_queue
+        self._mosaic = mosaic
+        self._rate_limiter = rate_limiter
+        self._metrics = Metrics() if diagnostics else None
+        self._priority = priority
+        self._batch_events = batch_events
+        self._label_events = (
+            {name.lower() for name in label_events} if label_events is not None else None
+        )
+        self._label_min_confidence = label_min_confidence
+        self._executor = executor
+        self._max_concurrent_requests = max_concurrent_requests
+        self._in_flight = 0  # images being processed
+        self._pending = None  # (image, future) waiting to be processed
+        self._coalesced = 0  # images replaced by a newer one while waiting
+        self._result_lock = asyncio.Lock()
+        self._frame_cache = None
+        if dedup_max_distance is not None:
+            self._frame_cache = FrameCache(dedup_max_distance, dedup_ttl)
+        self._motion_gate = None
+        if motion_threshold is not None:
+            self._motion_gate = MotionGate(motion_threshold, self._roi_dict)
+        self._result_cache = result_cache
+        self._archive = archive
+        if archive is not None:
+            archive.set_limits(
+                self._name,
+                save_max_files,
+                int(save_max_size * 1024 * 1024) if save_max_size else None,
+                save_max_age * 24 * 60 * 60 if save_max_age else None,
+                f".{save_file_format}",
+            )
+        self._fan_out = fan_out
+        self._stream = stream
+        self._stream_interval = stream_interval
+        self._stream_idle_interval = stream_idle_interval
+        self._stream_processor = None
+        self._shared_fetches = 0
+        self._shared_detections = 0
+        self._result_cache_hits = 0
+        self._result_cache_misses = 0
+        self._tracker = None
+        if tracking:
+            self._tracker = ObjectTracker(track_min_iou, track_max_missed)
+        self._new_targets = []  # targets which weren't tracked before this frame
+        self._departed = []  # tracks which departed in this frame
+
+        self._attribute_profile = attributes
+        if max_attribute_items is None and attributes != FULL:
+            max_attribute_items = DEFAULT_MAX_ATTRIBUTE_ITEMS
+        self._max_attribute_items = max_attribute_items
+        self._config_attributes = {}  # static, only in the full profile
+        if attributes == FULL:
+            self._config_attributes["targets"] = self._targets
+            if self._save_file_folder:
+                self._config_attributes.update(
+                    {
+                        CONF_SAVE_FILE_FORMAT: self._save_file_format,
+                        CONF_SAVE_FILE_FOLDER: str(self._save_file_folder),
+                        CONF_SAVE_TIMESTAMPTED_FILE: self._save_timestamped_file,
+                        CONF_ALWAYS_SAVE_LATEST_FILE: self._always_save_latest_file,
+                        CONF_SHOW_BOXES: self._show_boxes,
+                    }
+                )
+            if self._s3_bucket:
+                self._config_attributes[CONF_S3_BUCKET] = self._s3_bucket
+        self._frame_attributes = self.frame_attributes()
 
     def process_image(self, image):
         """Process an image."""
-        self._image = Image.open(io.BytesIO(bytearray(image)))  # used for saving only
-        self._image_width, self._image_height = self._image.size
+        frame = self.prepare_image(image)
+        if not frame.motion:
+            return
+        if self.process_cached(frame):
+            if not self.tracking_changed():
+                return
+        else:
+            response = frame.response
+            if response is None:
+                response = self.detect_frame(frame)
+            self.process_response(response, frame)
+        saved_image_path = None
+        if self._save_queue:
+            if self.should_save():
+                self.queue_save()
+        else:
+            saved_image_path = self.save_latest()
+        self.fire_events(self.hass.bus.fire, saved_image_path)
+
+    async def async_added_to_hass(self):
+        """Start processing the camera's stream, in stream mode."""
+        if not self._stream:
+            return
+        source = await camera.async_get_stream_source(self.hass, self.camera_entity)
+        if not source:
+            _LOGGER.error("Rekognition found no stream for %s", self.camera_entity)
+            return
+        fps = 1 / self._stream_interval
+        self._stream_processor = StreamProcessor(
+            self,
+            functools.partial(ffmpeg_frames, source, fps),
+            self._stream_interval,
+            self._stream_idle_interval,
+        )
+        self._stream_processor.start()
+        self.async_on_remove(self._stream_processor.stop)
+
+    async def async_update(self):
+        """Fetch the camera image and process it.
+
+        Entities watching the same camera share one fetch. In stream mode
+        the stream processor feeds the entity instead.
+        """
+        if self._stream_processor:
+            return
+        if self._fan_out is None:
+            await super().async_update()
+            return
+
+        async def fetch():
+            return await camera.async_get_image(
+                self.hass, self.camera_entity, timeout=self.timeout
+            )
+
+        # Only fetches in flight are shared, a later scan wants a newer image
+        key = ("fetch", self.camera_entity)
+        try:
+            image, shared = await self._fan_out.run(key, fetch, window=0)
+        except HomeAssistantError as err:
+            _LOGGER.error("Error on receive image from entity: %s", err)
+            return
+        self._shared_fetches += shared
+        await self.async_process_image(image.content)
+
+    async def async_process_image(self, image):
+        """Process an image, coalescing scans which arrive while busy.
+
+        Up to max_concurrent_requests images per entity are processed at
+        once. Beyond that, the newest image replaces any image already
+        waiting, and every caller waiting is done once it has been processed.
+        """
+        if self._in_flight >= self._max_concurrent_requests:
+            if self._pending is None:
+                self._pending = (image, self.hass.loop.create_future())
+            else:
+                self._pending = (image, self._pending[1])
+                self._coalesced += 1
+            await asyncio.shield(self._pending[1])
+            return
+
+        self._in_flight += 1
+        try:
+            try:
+                await self.async_process_frame(image)
+            finally:
+                # The waiting image is processed even if this one failed
+                while self._pending is not None:
+                    image, future = self._pending
+                    self._pending = None
+                    try:
+                        await self.async_process_frame(image)
+                    except asyncio.CancelledError:
+                        future.cancel()
+                        raise
+                    except Exception as err:  # pylint: disable=broad-except
+                        future.set_exception(err)
+                    else:
+                        future.set_result(None)
+        finally:
+            self._in_flight -= 1
+
+    async def async_process_frame(self, image):
+        """Process an image, running the Rekognition call in the dedicated pool.
+
+        The results are applied one at a time in the order they complete. In
+        mosaic mode the call is shared with other cameras of the platform.
+        """
+        frame = await self.hass.async_add_executor_job(self.prepare_image, image)
+        if not frame.motion:
+            return
+        if self.process_cached(frame):
+            if self.tracking_changed():
+                await self.async_publish(frame)
+            return
+        response = frame.response
+        if response is None:
+            response = await self.async_detect_labels(frame)
+        if response is None:
+            return  # replaced by a newer frame while waiting
+        await self.async_publish(frame, response)
+
+    async def async_publish(self, frame, response=None):
+        """Apply a response to the entity, then save the image and fire events.
+
+        Without a response, the frame's detections were already applied.
+        """
+        async with self._result_lock:
+            if response is not None:
+                self.process_response(response, frame)
+            saved_image_path = None
+            if self._save_queue:
+                if self.should_save():
+                    if self._save_queue.blocking:
+                        await self.hass.async_add_executor_job(self.queue_save)
+                    else:
+                        self.queue_save()
+            elif self.should_save():
+                saved_image_path = await self.hass.async_add_executor_job(
+                    self.save_latest
+                )
+            self.fire_events(self.hass.bus.async_fire, saved_image_path)
+
+    async def async_detect_labels(self, frame):
+        """Call Rekognition for the frame, through the rate limiter if configured.
+
+        Returns: the response, or None if a newer frame replaced this one.
+        """
+
+        async def call():
+            if self._mosaic:
+                with self.measure("detect"):
+                    response = await self._mosaic.detect_labels(frame)
+                if self._result_cache is not None:
+                    await self.hass.async_add_executor_job(
+                        self._result_cache.put, frame.cache_key, response
+                    )
+                return response
+            return await self.hass.loop.run_in_executor(
+                self._executor, self.detect_frame, frame
+            )
+
+        async def limited_call():
+            if self._rate_limiter is None:
+                return await call()
+            return await self._rate_limiter.run(self.entity_id, self._priority, call)
+
+        if self._fan_out is None:
+            return await limited_call()
+        # Entities sending the same bytes to the same detector share the call
+        key = (
+            "detect",
+            hashlib.blake2b(frame.data, digest_size=16).digest(),
+            self.detector_key,
+        )
+        response, shared = await self._fan_out.run(key, limited_call)
+        if response is None and shared:
+            # The entity sharing the call replaced it with a newer frame
+            response = await limited_call()
+            shared = False
+        self._shared_detections += shared
+        return response
+
+    @property
+    def detector_key(self):
+        """Identify the detector, Rekognition clients all give the same results."""
+        if isinstance(self._aws_rekognition_client, SharedClient):
+            return REKOGNITION
+        return id(self._aws_rekognition_client)
+
+    def measure(self, stage):
+        """Return a context manager timing a stage, if diagnostics are enabled."""
+        if self._metrics is None:
+            return NOT_MEASURED
+        return self._metrics.measure(self.entity_id, stage)
+
+    def count(self, counter, value=1):
+        """Add to a counter, if diagnostics are enabled."""
+        if self._metrics is not None:
+            self._metrics.increment(self.entity_id, counter, value)
+
+    def prepare_image(self, image) -> Frame:
+        """Apply the scale and run the optional gates.
+
+        The image is only decoded if one of these needs the pixels. Frames
+        without motion are marked, and the rest are hashed if deduplication
+        is enabled.
+        """
+        frame = Frame(image)
 
         # resize image if different then default
         if self._scale != DEAULT_SCALE:
-            newsize = (self._image_width * self._scale, self._image_width * self._scale)
-            self._image.thumbnail(newsize, Image.ANTIALIAS)
-            self._image_width, self._image_height = self._image.size
-            with io.BytesIO() as output:
-                self._image.save(output, format="JPEG")
-                image = output.getvalue()
+            pil_image = frame.image
+            width, height = pil_image.size
+            newsize = (
+                max(round(width * self._scale), 1),
+                max(round(height * self._scale), 1),
+            )
+            # JPEGs are downscaled by the decoder to at least newsize, this is
+            # much cheaper than decoding at full size. The rest is resized.
+            with self.measure("decode"):
+                pil_image.draft("RGB", newsize)
+                pil_image.load()
+                if pil_image.mode != "RGB":
+                    pil_image = pil_image.convert("RGB")
+            with self.measure("encode"), io.BytesIO() as output:
+                if pil_image.size != newsize:
+                    pil_image = pil_image.resize(newsize, Image.BILINEAR)
+                pil_image.save(output, format="JPEG", quality=self._jpeg_quality)
+                frame = Frame(output.getvalue(), pil_image)
             _LOGGER.debug(
-                (
-                    f"Image scaled with : {self._scale} W={self._image_width} H={self._image_height}"
-                )
+                (f"Image scaled with : {self._scale} W={newsize[0]} H={newsize[1]}")
             )
 
-        self._state = None
-        self._objects = []
-        self._labels = []
-        self._targets_found = []
-        self._summary = {target: 0 for target in self._targets_names}
-        saved_image_path = None
+        if self._motion_gate:
+            with self.measure("motion"):
+                frame.motion = self._motion_gate.update(frame.image)
+            if not frame.motion:
+                _LOGGER.debug(
+                    "Rekognition skipped frame, motion score %.2f",
+                    self._motion_gate.score,
+                )
+                return frame
+        if self._frame_cache:
+            with self.measure("hash"):
+                frame.hash = dhash(frame.image)
+        if self._crop:
+            with self.measure("encode"):
+                self.crop_frame(frame)
+        if self._result_cache is not None:
+            with self.measure("cache"):
+                self.lookup_response(frame, image)
+        return frame
 
-        response = self._aws_rekognition_client.detect_labels(Image={"Bytes": image})
-        self._objects, self._labels = get_objects(response)
-        self._targets_found = []
+    @property
+    def motion_detected(self) -> bool:
+        """True if the motion gate saw motion in the last frame."""
+        return bool(self._motion_gate and self._motion_gate.motion)
+
+    def lookup_response(self, frame, image):
+        """Look up the response for the original image in the result cache."""
+        frame.cache_key = ResultCache.key(
+            image,
+            self._scale,
+            self._jpeg_quality,
+            self._crop,
+            getattr(self._aws_rekognition_client, "cache_id", REKOGNITION),
+        )
+        frame.response = self._result_cache.get(frame.cache_key)
+        if frame.response is None:
+            self._result_cache_misses += 1
+        else:
+            self._result_cache_hits += 1
+            _LOGGER.debug("Rekognition response found in the result cache")
+
+    def crop_frame(self, frame):
+        """Replace the data to send with the ROI, plus margin, of the image."""
+        width, height = frame.size
+        x_min, y_min, x_max, y_max = self._crop
+        box = (
+            int(x_min * width),
+            int(y_min * height),
+            max(round(x_max * width), int(x_min * width) + 1),
+            max(round(y_max * height), int(y_min * height) + 1),
+        )
+        cropped = frame.image.crop(box)
+        if cropped.mode != "RGB":
+            cropped = cropped.convert("RGB")
+        with io.BytesIO() as output:
+            cropped.save(output, format="JPEG", quality=self._jpeg_quality)
+            frame.data = output.getvalue()
+        frame.crop = (box[0] / width, box[1] / height, box[2] / width, box[3] / height)
+
+    def process_cached(self, frame) -> bool:
+        """Apply the result of a near identical recent frame, if there is one.
+
+        Saving and events are skipped, as they would repeat the previous ones,
+        unless tracking_changed() shows objects arrived or departed.
+        """
+        if not self._frame_cache:
+            return False
+        result = self._frame_cache.get(frame.hash)
+        if result is None:
+            return False
+        _LOGGER.debug("Rekognition reused the result of a similar frame")
+        self.process_detections(result, frame)
+        return True
 
-        for obj in self._objects:
-            if not ((obj["name"] in self._targets_names)):
-                continue
-            ## Then if a confidence for a named object, this takes precedence over type confidence
-            confidence = None
-            for target in self._targets:
-                if obj["name"] == target[CONF_TARGET]:
-                    confidence = target[CONF_CONFIDENCE]
-            if obj["confidence"] > confidence:
-                if not object_in_roi(self._roi_dict, obj["centroid"]):
-                    continue
-                self._targets_found.append(obj)
+    def detect_labels(self, image):
+        """Call Rekognition, this blocks for the whole round trip."""
+        self.count("api_calls")
+        self.count("bytes_sent", len(image))
+        try:
+            with self.measure("detect"):
+                return self._aws_rekognition_client.detect_labels(
+                    Image={"Bytes": image}
+                )
+        except Exception:
+            self.count("errors")
+            raise
+
+    def detect_frame(self, frame):
+        """Call the detector for a frame, storing the response in the result cache."""
+        response = self.detect_labels(frame.data)
+        if self._result_cache is not None:
+            self._result_cache.put(frame.cache_key, response)
+        return response
+
+    def process_response(self, response, frame):
+        """Parse the response and update the entity state."""
+        with self.measure("parse"):
+            detections = get_detections(response, frame.crop)
+        if self._frame_cache:
+            self._frame_cache.put(frame.hash, detections)
+        self.process_detections(detections, frame)
+
+    def filter_targets(self, detections) -> np.ndarray:
+        """Return the indices of the targets above their confidence in the ROI."""
+        ## A confidence for a named object takes precedence over type confidence
+        thresholds = np.array(
+            [self._targets_confidences.get(name, np.inf) for name in detections.names],
+            dtype=float,
+        )
+        centroid_x, centroid_y = detections.centroids.T
+        roi = self._roi_dict
+        mask = (
+            (detections.confidences > thresholds)
+            & (roi["x_min"] <= centroid_x)
+            & (centroid_x <= roi["x_max"])
+            & (roi["y_min"] <= centroid_y)
+            & (centroid_y <= roi["y_max"])
+        )
+        return np.flatnonzero(mask)
+
+    def process_detections(self, detections, frame):
+        """Filter the detections for targets and update the entity state."""
+        self._frame = frame
+        self._image_width, self._image_height = frame.size
+        self._detections = detections
+        self._labels = detections.labels
+        with self.measure("filter"):
+            indices = self.filter_targets(detections)
+            self._targets_found = [detections.object(index) for index in indices]
+            if self._zone_map:
+                zone_bits = self._zone_map.lookup(
+                    detections.centroids[indices], frame.size
+                )
+                for obj, bits in zip(self._targets_found, zone_bits):
+                    obj["zones"] = self._zone_map.zone_names(bits)
+        if self._tracker is not None:
+            with self.measure("track"):
+                self.track_targets(detections.boxes[indices, :4])
 
         self._state = len(self._targets_found)
 
@@ -407,24 +2763,142 @@ class ObjectDetection(ImageProcessingEntity):
         for target in self._targets_names:
             if target not in self._summary.keys():
                 self._summary.update({target: 0})
+        if self._zone_map:
+            self._summary["zones"] = {
+                zone: {target: 0 for target in self._targets_names}
+                for zone in self._zone_map.names
+            }
+            for obj in self._targets_found:
+                for zone in obj["zones"]:
+                    self._summary["zones"][zone][obj["name"]] += 1
+        self._frame_attributes = self.frame_attributes()
+
+    def track_targets(self, boxes):
+        """Give the targets track ids, and note which are new or departed."""
+        names = [obj["name"] for obj in self._targets_found]
+        ids, new, self._departed = self._tracker.update(names, boxes)
+        for obj, track_id in zip(self._targets_found, ids.tolist()):
+            obj["track_id"] = track_id
+        self._new_targets = [
+            obj for obj, is_new in zip(self._targets_found, new.tolist()) if is_new
+        ]
 
-        if self._save_file_folder:
-            if self._state > 0 or self._always_save_latest_file:
-                saved_image_path = self.save_image(
-                    self._targets_found, self._save_file_folder,
-                )
+    def targets_changed(self) -> bool:
+        """Return False if tracking shows the same objects as the last frame."""
+        return self._tracker is None or bool(self._new_targets or self._departed)
+
+    def tracking_changed(self) -> bool:
+        """Return True if tracking is enabled and objects arrived or departed."""
+        return self._tracker is not None and self.targets_changed()
 
-        # Fire events
-        for target in self._targets_found:
+    def frame_attributes(self) -> dict:
+        """Return the attributes which only change when a frame is processed.
+
+        These are built once per frame rather than on every state write, and
+        all_objects and labels keep only the most confident items.
+        """
+        attr = {"summary": self._summary}
+        if self._last_detection:
+            attr["last_target_detection"] = self._last_detection
+        if self._attribute_profile == MINIMAL:
+            return attr
+        attr["targets_found"] = [
+            {obj["name"]: obj["confidence"]} for obj in self._targets_found
+        ]
+        limit = self._max_attribute_items
+        confidences = self._detections.confidences
+        indices = np.argsort(-confidences, kind="stable")[:limit].tolist()
+        attr["all_objects"] = [
+            {self._detections.names[index]: confidence}
+            for index, confidence in zip(indices, confidences[indices].tolist())
+        ]
+        labels = self._labels
+        if limit is not None and len(labels) > limit:
+            labels = sorted(labels, key=lambda label: -label["confidence"])[:limit]
+        attr["labels"] = labels
+        return attr
+
+    def should_save(self) -> bool:
+        """Return True if the processed image should be saved or uploaded."""
+        if self._save_file_folder and self._always_save_latest_file:
+            return True
+        if self._save_file_folder or self._s3_bucket:
+            return self._state > 0 and self.targets_changed()
+        return False
+
+    def save_latest(self):
+        """Save the processed image if configured, returns the saved path."""
+        if self.should_save():
+            return self.save_image(self._targets_found, self._save_file_folder)
+        return None
+
+    def queue_save(self):
+        """Queue the processed image for the save workers."""
+        job = functools.partial(
+            self.save_image,
+            self._targets_found,
+            self._save_file_folder,
+            self._frame,
+            self._last_detection,
+        )
+        if not self._save_queue.submit(job, self.image_saved):
+            _LOGGER.warning("Rekognition save queue is full, image dropped")
+
+    def image_saved(self, saved_image_path):
+        """Fire an event once a queued image has been saved."""
+        self.hass.bus.fire(
+            EVENT_IMAGE_SAVED,
+            {ATTR_ENTITY_ID: self.entity_id, SAVED_FILE: saved_image_path},
+        )
+
+    def fire_events(self, fire, saved_image_path):
+        """Fire the object and label events using the given bus method."""
+        with self.measure("events"):
+            self._fire_events(fire, saved_image_path)
+
+    def _fire_events(self, fire, saved_image_path):
+        labels = self.event_labels()
+        departed = [
+            {ATTR_ENTITY_ID: self.entity_id, "track_id": track_id, "name": name}
+            for track_id, name in self._departed
+        ]
+        if self._batch_events:
+            event_data = {
+                ATTR_ENTITY_ID: self.entity_id,
+                "targets": self._targets_found,
+                "labels": labels,
+            }
+            if self._tracker is not None:
+                event_data["new"] = [obj["track_id"] for obj in self._new_targets]
+                event_data["departed"] = departed
+            if saved_image_path:
+                event_data[SAVED_FILE] = saved_image_path
+            fire(EVENT_FRAME_PROCESSED, event_data)
+            return
+        targets = self._targets_found
+        if self._tracker is not None:
+            targets = self._new_targets
+        for target in targets:
             target_event_data = target.copy()
             target_event_data[ATTR_ENTITY_ID] = self.entity_id
             if saved_image_path:
                 target_event_data[SAVED_FILE] = saved_image_path
-            self.hass.bus.fire(EVENT_OBJECT_DETECTED, target_event_data)
-        for label in self._labels:
+            fire(EVENT_OBJECT_DETECTED, target_event_data)
+        for departed_event_data in departed:
+            fire(EVENT_OBJECT_DEPARTED, departed_event_data)
+        for label in labels:
             label_event_data = label.copy()
             label_event_data[ATTR_ENTITY_ID] = self.entity_id
-            self.hass.bus.fire(EVENT_LABEL_DETECTED, label_event_data)
+            fire(EVENT_LABEL_DETECTED, label_event_data)
+
+    def event_labels(self) -> list:
+        """Return the labels allowed by label_events and label_min_confidence."""
+        return [
+            label
+            for label in self._labels
+            if label["confidence"] >= self._label_min_confidence
+            and (self._label_events is None or label["name"] in self._label_events)
+        ]
 
     @property
     def camera_entity(self):
@@ -454,38 +2928,118 @@ class ObjectDetection(ImageProcessingEntity):
     @property
     def extra_state_attributes(self):
         """Return device specific state attributes."""
-        attr = {}
-        attr["targets"] = self._targets
-        attr["targets_found"] = [
-            {obj["name"]: obj["confidence"]} for obj in self._targets_found
-        ]
-        attr["summary"] = self._summary
-        if self._last_detection:
-            attr["last_target_detection"] = self._last_detection
-        attr["all_objects"] = [
-            {obj["name"]: obj["confidence"]} for obj in self._objects
-        ]
-        if self._save_file_folder:
-            attr[CONF_SAVE_FILE_FORMAT] = self._save_file_format
-            attr[CONF_SAVE_FILE_FOLDER] = str(self._save_file_folder)
-            attr[CONF_SAVE_TIMESTAMPTED_FILE] = self._save_timestamped_file
-            attr[CONF_ALWAYS_SAVE_LATEST_FILE] = self._always_save_latest_file
-            attr[CONF_SHOW_BOXES] = self._show_boxes
-        if self._s3_bucket:
-            attr[CONF_S3_BUCKET] = self._s3_bucket
-        attr["labels"] = self._labels
+        attr = {**self._config_attributes, **self._frame_attributes}
+        if self._attribute_profile == MINIMAL:
+            return attr
+        if self._frame_cache:
+            attr["dedup_hits"] = self._frame_cache.hits
+            attr["dedup_misses"] = self._frame_cache.misses
+        if self._motion_gate and self._motion_gate.score is not None:
+            attr["motion_score"] = round(self._motion_gate.score, 3)
+            attr["motion_detected"] = self._motion_gate.motion
+        attr["coalesced_scans"] = self._coalesced
+        if self._rate_limiter:
+            attr["rate_limit"] = round(self._rate_limiter.rate, 2)
+            attr["rate_limit_wait_ms"] = round(self._rate_limiter.wait_time * 1000, 1)
+            attr["rate_limit_throttles"] = self._rate_limiter.throttles
+            attr["rate_limit_dropped"] = self._rate_limiter.dropped
+        if self._save_queue:
+            attr["save_queue_depth"] = self._save_queue.depth
+            attr["save_queue_dropped"] = self._save_queue.dropped
+            if self._save_queue.latency is not None:
+                attr["save_latency_ms"] = round(self._save_queue.latency * 1000, 1)
+        if self._stream_processor:
+            attr["stream_frames_read"] = self._stream_processor.read
+            attr["stream_frames_sampled"] = self._stream_processor.sampled
+            attr["stream_frames_dropped"] = self._stream_processor.dropped
+            attr["stream_frames_processed"] = self._stream_processor.processed
+        if self._archive is not None:
+            attr["saved_files"] = self._archive.files(self._name)
+            attr["saved_bytes"] = self._archive.size(self._name)
+        if self._fan_out is not None:
+            attr["shared_fetches"] = self._shared_fetches
+            attr["shared_detections"] = self._shared_detections
+        if self._result_cache is not None:
+            attr["result_cache_hits"] = self._result_cache_hits
+            attr["result_cache_misses"] = self._result_cache_misses
+        if isinstance(self._aws_rekognition_client, CascadeDetector):
+            attr["cascade_local_results"] = self._aws_rekognition_client.local_results
+            attr["cascade_escalations"] = self._aws_rekognition_client.escalations
+        if self._metrics:
+            attr.update(self._metrics.as_dict())
         return attr
 
-    def save_image(self, targets, directory) -> str:
+    def save_image(self, targets, directory, frame=None, last_detection=None) -> str:
         """Draws the actual bounding box of the detected objects.
 
-        Returns: saved_image_path, which is the path to the saved timestamped file if configured, else the default saved image.
+        The frame and detection time default to those last processed.
+
+        Returns: saved_image_path, which is the path to the saved timestamped file if configured, else the default saved image, or the S3 URL if there is no folder.
         """
+        frame = frame or self._frame
+        last_detection = last_detection or self._last_detection
         try:
-            img = self._image.convert("RGB")
+            with self.measure("draw"):
+                img = self.draw_image(frame, targets)
         except UnidentifiedImageError:
             _LOGGER.warning("Rekognition unable to process image, bad data")
+            self.count("errors")
             return
+
+        # Encoded once, the same bytes go to every destination
+        with self.measure("write"), io.BytesIO() as output:
+            img.save(
+                output, format=PIL_FORMATS[self._save_file_format], **self._save_options
+            )
+            data = output.getvalue()
+
+        saved_image_path = None
+        if directory:
+            latest_save_path = (
+                directory / f"{get_valid_filename(self._name).lower()}_latest.{self._save_file_format}"
+            )
+            with self.measure("write"):
+                latest_save_path.write_bytes(data)
+            _LOGGER.info("Rekognition saved file %s", latest_save_path)
+            saved_image_path = str(latest_save_path)
+
+        # Without a folder, detections are only archived to S3
+        if targets and (self._save_timestamped_file or not directory):
+            filename = f"{self._name}_{last_detection}.{self._save_file_format}"
+            if directory and self._save_timestamped_file:
+                if self._archive is not None:
+                    # The detection time starts with the date
+                    timestamp_save_path = self._archive.path(
+                        filename, last_detection[:10]
+                    )
+                else:
+                    timestamp_save_path = directory / filename
+                with self.measure("write"):
+                    timestamp_save_path.write_bytes(data)
+                if self._archive is not None:
+                    self._archive.add(self._name, timestamp_save_path, len(data))
+                _LOGGER.info("Rekognition saved file %s", timestamp_save_path)
+                saved_image_path = str(timestamp_save_path)
+            if self._s3_bucket:
+                try:
+                    with self.measure("upload"):
+                        upload_bytes(
+                            self._aws_s3_client, data, self._s3_bucket, filename
+                        )
+                except Exception:
+                    self.count("errors")
+                    raise
+                self.count("bytes_uploaded", len(data))
+                _LOGGER.info(
+                    f"Uploaded file {filename} to S3"
+                )
+                if not saved_image_path:
+                    saved_image_path = f"s3://{self._s3_bucket}/{filename}"
+        return saved_image_path
+
+    def draw_image(self, frame, targets) -> Image.Image:
+        """Return a copy of the frame with the ROI, zones and targets drawn."""
+        img = frame.image.convert("RGB")
         draw = ImageDraw.Draw(img)
 
         roi_tuple = tuple(self._roi_dict.values())
@@ -494,6 +3048,12 @@ class ObjectDetection(ImageProcessingEntity):
                 draw, roi_tuple, img.width, img.height, text="ROI", color=GREEN,
             )
 
+        if self._zone_map and self._show_boxes:
+            for name, polygon in zip(self._zone_map.names, self._zone_map.polygons):
+                points = [(x * img.width, y * img.height) for x, y in polygon]
+                draw.polygon(points, outline=GREEN)
+                draw.text(points[0], text=name, fill=GREEN)
+
         for obj in targets:
             if not self._show_boxes:
                 break
@@ -519,22 +3079,4 @@ class ObjectDetection(ImageProcessingEntity):
                 fill=RED,
             )
 
-        latest_save_path = (
-            directory / f"{get_valid_filename(self._name).lower()}_latest.{self._save_file_format}"
-        )
-        img.save(latest_save_path)
-        _LOGGER.info("Rekognition saved file %s", latest_save_path)
-        saved_image_path = latest_save_path
-
-        if targets and self._save_timestamped_file:
-            filename = f"{self._name}_{self._last_detection}.{self._save_file_format}"
-            timestamp_save_path = directory / filename
-            img.save(timestamp_save_path)
-            _LOGGER.info("Rekognition saved file %s", timestamp_save_path)
-            if self._s3_bucket:
-                self._aws_s3_client.upload_file(Filename=str(timestamp_save_path), Bucket=self._s3_bucket, Key=filename)
-                _LOGGER.info(
-                    f"Uploaded file {filename} to S3"
-                )
-            return str(timestamp_save_path)
-        return str(saved_image_path)
+        return img
@@ -1,5 +1,56 @@
 """The tests for the Amazon Rekognition component."""
-from .image_processing import get_objects
+import asyncio
+import io
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+import voluptuous as vol
+from PIL import Image
+
+from . import image_processing
+from .image_processing import (
+    CONF_ACCESS_KEY_ID,
+    CONF_REGION,
+    CONF_SECRET_ACCESS_KEY,
+    CascadeDetector,
+    ClientRegistry,
+    DEFAULT_TARGETS,
+    DROP_NEWEST,
+    DROP_OLDEST,
+    EVENT_FRAME_PROCESSED,
+    EVENT_IMAGE_SAVED,
+    EVENT_LABEL_DETECTED,
+    EVENT_OBJECT_DEPARTED,
+    EVENT_OBJECT_DETECTED,
+    FanOut,
+    Frame,
+    FrameCache,
+    LocalDetector,
+    Histogram,
+    MosaicBatcher,
+    RateLimiter,
+    ResultCache,
+    MotionGate,
+    ObjectDetection,
+    ObjectTracker,
+    PLATFORM_SCHEMA,
+    SaveQueue,
+    SnapshotArchive,
+    StreamProcessor,
+    ZoneMap,
+    add_metrics_listener,
+    compose_mosaic,
+    dhash,
+    get_detections,
+    get_objects,
+    jpeg_frames,
+    hamming_distance,
+    split_mosaic_response,
+)
 
 TARGET = "person"
 MOCK_HIGH_CONFIDENCE = 95.0
@@ -179,3 +230,1040 @@ def test_get_objects():
     assert len(labels) == 9
     assert objects[0] == PARSED_RESPONSE
     assert labels[0] == {"name": "human", "confidence": 99.853}
+
+
+class MockRekognitionClient:
+    def __init__(self, response=MOCK_RESPONSE):
+        self.response = response
+        self.calls = 0
+
+    def detect_labels(self, Image):
+        self.calls += 1
+        return self.response
+
+
+class MockBus:
+    def __init__(self):
+        self.events = []
+
+    def fire(self, event_type, event_data=None):
+        self.events.append((event_type, event_data))
+
+    async_fire = fire
+
+
+class MockHass:
+    def __init__(self, loop):
+        self.loop = loop
+        self.bus = MockBus()
+
+    def async_add_executor_job(self, target, *args):
+        return self.loop.run_in_executor(None, target, *args)
+
+
+def make_image(width=64, height=48, color=(0, 0, 0)):
+    with io.BytesIO() as output:
+        Image.new("RGB", (width, height), color).save(output, format="JPEG")
+        return output.getvalue()
+
+
+def make_entity(client, **kwargs):
+    config = dict(
+        rekognition_client=client,
+        s3_client=None,
+        region="us-east-1",
+        targets=[dict(target) for target in DEFAULT_TARGETS],
+        confidence=80,
+        roi_y_min=0.0,
+        roi_x_min=0.0,
+        roi_y_max=1.0,
+        roi_x_max=1.0,
+        scale=1.0,
+        show_boxes=True,
+        save_file_format="jpg",
+        save_file_folder=None,
+        save_timestamped_file=False,
+        always_save_latest_file=False,
+        s3_bucket=None,
+        camera_entity="camera.test",
+    )
+    config.update(kwargs)
+    entity = ObjectDetection(**config)
+    entity.entity_id = "image_processing.rekognition_test"
+    return entity
+
+
+def test_async_process_image():
+    async def scan():
+        entity = make_entity(MockRekognitionClient(), max_concurrent_requests=2)
+        entity.hass = MockHass(asyncio.get_running_loop())
+        await asyncio.gather(
+            entity.async_process_image(make_image()),
+            entity.async_process_image(make_image()),
+        )
+        return entity
+
+    entity = asyncio.run(scan())
+    assert entity.state == 2
+    assert entity._aws_rekognition_client.calls == 2
+    event_types = [event_type for event_type, _ in entity.hass.bus.events]
+    assert event_types.count(EVENT_OBJECT_DETECTED) == 4
+    assert event_types.count(EVENT_LABEL_DETECTED) == 18
+
+
+def test_dhash():
+    gradient = Image.linear_gradient("L").resize((64, 48))
+    assert dhash(gradient) == dhash(gradient.point(lambda value: value // 2 + 10))
+    gradient = gradient.rotate(90, expand=True).resize((64, 48))
+    flipped = gradient.transpose(Image.FLIP_LEFT_RIGHT)
+    assert hamming_distance(dhash(gradient), dhash(flipped)) > 32
+
+
+def test_frame_cache():
+    cache = FrameCache(max_distance=2, ttl=10)
+    cache.put(0b1111, "result", now=0)
+    assert cache.get(0b1100, now=5) == "result"
+    assert cache.get(0b0000, now=5) is None
+    assert cache.get(0b1111, now=11) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_process_image_dedup():
+    client = MockRekognitionClient()
+    entity = make_entity(client, dedup_max_distance=0)
+    entity.hass = MockHass(None)
+    entity.process_image(make_image())
+    events = len(entity.hass.bus.events)
+    entity.process_image(make_image())
+    assert client.calls == 1
+    assert len(entity.hass.bus.events) == events
+    assert entity.state == 2
+    assert entity.extra_state_attributes["dedup_hits"] == 1
+    assert entity.extra_state_attributes["dedup_misses"] == 1
+
+
+def test_motion_gate():
+    roi = {"y_min": 0.0, "x_min": 0.5, "y_max": 1.0, "x_max": 1.0}
+    gate = MotionGate(threshold=5, roi=roi)
+    still = Image.new("L", (200, 100))
+    assert gate.update(still)  # the first frame always passes
+    assert not gate.update(still)
+    assert gate.score == 0
+
+    # Motion outside the ROI is ignored
+    outside = still.copy()
+    outside.paste(255, (0, 0, 100, 100))
+    assert not gate.update(outside)
+
+    inside = still.copy()
+    inside.paste(255, (150, 0, 200, 100))
+    assert gate.update(inside)
+    assert 45 < gate.score < 55
+
+
+def test_process_image_motion_gate():
+    client = MockRekognitionClient()
+    entity = make_entity(client, motion_threshold=1)
+    entity.hass = MockHass(None)
+    entity.process_image(make_image())
+    entity.process_image(make_image())
+    assert client.calls == 1
+    assert entity.extra_state_attributes["motion_detected"] is False
+    entity.process_image(make_image(color=(255, 255, 255)))
+    assert client.calls == 2
+    assert entity.extra_state_attributes["motion_score"] == 100
+
+
+def test_client_registry():
+    registry = ClientRegistry()
+    aws_config = {
+        CONF_REGION: "eu-west-1",
+        CONF_ACCESS_KEY_ID: "key",
+        CONF_SECRET_ACCESS_KEY: "secret",
+    }
+    first = registry.reserve("rekognition", aws_config, 8)
+    second = registry.reserve("rekognition", aws_config, 8)
+    other = registry.reserve("rekognition", {**aws_config, CONF_REGION: "us-east-1"}, 1)
+    assert first.meta is second.meta
+    assert first.meta is not other.meta
+    assert first.meta.region_name == "eu-west-1"
+    assert first.meta.config.max_pool_connections == 16
+    assert other.meta.config.max_pool_connections == 10
+
+
+def test_prepare_image_scale():
+    entity = make_entity(None, scale=0.5)
+    frame = entity.prepare_image(make_image(width=100, height=200))
+    assert frame.image.size == (50, 100)
+    assert Image.open(io.BytesIO(frame.data)).size == (50, 100)
+
+
+def test_process_image_without_decode():
+    entity = make_entity(MockRekognitionClient())
+    entity.hass = MockHass(None)
+    image = make_image(width=64, height=48)
+    frame = entity.prepare_image(image)
+    assert frame.data is image
+    assert frame._image is None
+    entity.process_image(image)
+    assert entity._frame.size == (64, 48)
+    assert entity._frame.image.tile  # only the header was read
+
+
+def test_save_queue_policies():
+    for policy, expected in ((DROP_OLDEST, [1, 3]), (DROP_NEWEST, [1, 2])):
+        release = threading.Event()
+        saved = []
+        save_queue = SaveQueue(workers=1, size=1, policy=policy)
+        save_queue.submit(lambda: release.wait() and 1, saved.append)
+        while save_queue.depth:  # wait for the worker to take the first job
+            pass
+        assert save_queue.submit(lambda: 2, saved.append)
+        assert save_queue.submit(lambda: 3, saved.append) == (policy == DROP_OLDEST)
+        assert save_queue.dropped == 1
+        release.set()
+        save_queue.shutdown()
+        for thread in save_queue._threads:
+            thread.join()
+        assert saved == expected
+
+
+def test_process_image_save_queue(tmp_path):
+    save_queue = SaveQueue(workers=1, size=2, policy=DROP_OLDEST)
+    entity = make_entity(
+        MockRekognitionClient(), save_file_folder=tmp_path, save_queue=save_queue
+    )
+    entity.hass = MockHass(None)
+    entity.process_image(make_image())
+    save_queue.shutdown()
+    save_queue._threads[0].join()
+
+    saved_file = str(tmp_path / "rekognition_test_latest.jpg")
+    event_data = {"entity_id": entity.entity_id, "saved_file": saved_file}
+    assert (EVENT_IMAGE_SAVED, event_data) in entity.hass.bus.events
+    assert entity.extra_state_attributes["save_queue_depth"] == 0
+    assert "save_latency_ms" in entity.extra_state_attributes
+
+
+class MockS3Client:
+    def __init__(self):
+        self.objects = {}
+        self.puts = 0
+
+    def put_object(self, Body, Bucket, Key):
+        self.puts += 1
+        self.objects[(Bucket, Key)] = Body
+
+
+def test_process_image_s3_only():
+    s3_client = MockS3Client()
+    entity = make_entity(
+        MockRekognitionClient(), s3_client=s3_client, s3_bucket="bucket"
+    )
+    entity.hass = MockHass(None)
+    entity.process_image(make_image())
+    ((bucket, key), body), = s3_client.objects.items()
+    assert bucket == "bucket"
+    assert key.startswith("rekognition_test_")
+    assert Image.open(io.BytesIO(body)).size == (64, 48)
+    event_type, event_data = entity.hass.bus.events[0]
+    assert event_data["saved_file"] == f"s3://bucket/{key}"
+
+
+def test_filter_targets():
+    def targets():
+        return [{"target": "person"}, {"target": "car", "confidence": 99.5}]
+
+    detections = get_detections(MOCK_RESPONSE)
+    entity = make_entity(None, targets=targets(), confidence=90)
+    assert entity.filter_targets(detections).tolist() == [0]
+
+    entity = make_entity(None, targets=targets(), confidence=80, roi_x_max=0.5)
+    assert entity.filter_targets(detections).tolist() == [1]
+    assert entity.filter_targets(get_detections({"Labels": []})).tolist() == []
+
+
+ZONES = [
+    {"name": "left", "points": [(0.0, 0.0), (0.5, 0.0), (0.5, 1.0), (0.0, 1.0)]},
+    {"name": "triangle", "points": [(0.0, 0.0), (1.0, 0.0), (0.0, 1.0)]},
+]
+
+
+def test_zone_map():
+    zone_map = ZoneMap(ZONES)
+    centroids = np.array([[0.1, 0.1], [0.4, 0.9], [0.9, 0.05], [0.9, 0.9]])
+    bits = zone_map.lookup(centroids, (2000, 1000))
+    assert zone_map.grid((2000, 1000)).shape == (512, 1024)
+    assert [zone_map.zone_names(value) for value in bits] == [
+        ["left", "triangle"],
+        ["left"],
+        ["triangle"],
+        [],
+    ]
+
+
+def test_process_image_zones():
+    entity = make_entity(MockRekognitionClient(), zones=ZONES)
+    entity.hass = MockHass(None)
+    entity.process_image(make_image())
+    assert entity.extra_state_attributes["summary"]["zones"] == {
+        "left": {"person": 1},
+        "triangle": {"person": 1},
+    }
+    zones = [data["zones"] for _, data in entity.hass.bus.events[:2]]
+    assert zones == [[], ["left", "triangle"]]
+
+
+PLATFORM_CONFIG = {
+    "platform": "amazon_rekognition",
+    "aws_access_key_id": "key",
+    "aws_secret_access_key": "secret",
+    "source": [{"entity_id": "camera.test"}],
+}
+
+
+def test_zones_schema():
+    # As loaded from YAML
+    zones = [{"name": "door", "points": [[0.1, 0.5], [0.4, 0.5], [0.4, 0.9]]}]
+    config = PLATFORM_SCHEMA({**PLATFORM_CONFIG, "zones": zones})
+    assert config["zones"][0]["points"] == [(0.1, 0.5), (0.4, 0.5), (0.4, 0.9)]
+    assert ZoneMap(config["zones"]).grid((10, 10)).any()
+
+
+def test_detector_schema(tmp_path):
+    model = tmp_path / "model.onnx"
+    labels = tmp_path / "labels.txt"
+    model.touch()
+    labels.write_text("person\n")
+    local = {"detector": "cascade", "local_model": str(model)}
+    with pytest.raises(vol.Invalid):
+        PLATFORM_SCHEMA({**PLATFORM_CONFIG, **local})
+    local["local_labels"] = str(labels)
+    assert PLATFORM_SCHEMA({**PLATFORM_CONFIG, **local})["detector"] == "cascade"
+    inverted = {"cascade_min_confidence": 90, "cascade_max_confidence": 10}
+    with pytest.raises(vol.Invalid):
+        PLATFORM_SCHEMA({**PLATFORM_CONFIG, **local, **inverted})
+
+
+def test_roi_crop():
+    entity = make_entity(
+        None, roi_x_min=0.5, roi_y_max=0.5, roi_crop=True, roi_crop_margin=0.1
+    )
+    frame = entity.prepare_image(make_image(width=100, height=100))
+    assert Image.open(io.BytesIO(frame.data)).size == (60, 60)
+    assert frame.crop == (0.4, 0.0, 1.0, 0.6)
+
+    response = {
+        "Labels": [
+            {
+                "Name": "Person",
+                "Confidence": 90.0,
+                "Instances": [
+                    {
+                        "BoundingBox": {
+                            "Width": 0.5,
+                            "Height": 0.5,
+                            "Left": 0.5,
+                            "Top": 0.0,
+                        },
+                        "Confidence": 90.0,
+                    }
+                ],
+            }
+        ]
+    }
+    obj = get_detections(response, frame.crop).object(0)
+    assert obj["bounding_box"] == {
+        "x_min": 0.7,
+        "y_min": 0.0,
+        "x_max": 1.0,
+        "y_max": 0.3,
+        "width": 0.3,
+        "height": 0.3,
+    }
+    assert obj["centroid"] == {"x": 0.85, "y": 0.15}
+    assert obj["box_area"] == 9.0
+
+
+def test_compose_mosaic():
+    images = [make_image(width=200, height=100) for _ in range(3)]
+    mosaic, tiles = compose_mosaic(images, tile_size=(100, 100))
+    assert Image.open(io.BytesIO(mosaic)).size == (200, 200)
+    assert tiles == [
+        (0.0, 0.0, 0.5, 0.25),
+        (0.5, 0.0, 1.0, 0.25),
+        (0.0, 0.5, 0.5, 0.75),
+    ]
+
+
+def test_split_mosaic_response():
+    tiles = [(0.0, 0.0, 0.5, 1.0), (0.5, 0.0, 1.0, 1.0)]
+    left, right = split_mosaic_response(MOCK_RESPONSE, tiles)
+    left_objects, left_labels = get_objects(left)
+    right_objects, right_labels = get_objects(right)
+    assert len(left_objects) + len(right_objects) == 5
+    assert left_labels == right_labels == get_objects(MOCK_RESPONSE)[1]
+    person = right_objects[0]
+    assert person["name"] == "person"
+    assert person["bounding_box"]["x_min"] == 0.75
+    assert person["bounding_box"]["width"] == 0.152
+    # The car centered in the left tile is clipped to it
+    car = [obj for obj in left_objects if obj["name"] == "car"][0]
+    assert car["bounding_box"]["x_max"] == 1.0
+
+
+def test_mosaic_batcher():
+    async def scan():
+        hass = MockHass(asyncio.get_running_loop())
+        client = MockRekognitionClient()
+        mosaic = MosaicBatcher(hass, client, None, 0.01, 4, 75)
+        entities = [make_entity(client, mosaic=mosaic) for _ in range(3)]
+        for entity in entities:
+            entity.hass = hass
+        image = make_image(width=1280, height=720)
+        await asyncio.gather(
+            *(entity.async_process_image(image) for entity in entities)
+        )
+        return client, entities
+
+    client, entities = asyncio.run(scan())
+    assert client.calls == 1
+    # Only the second person's centroid is within a tile, the third
+    assert [entity.state for entity in entities] == [0, 0, 1]
+
+
+def test_mosaic_batcher_cancelled():
+    async def scan():
+        hass = MockHass(asyncio.get_running_loop())
+        client = MockRekognitionClient()
+        mosaic = MosaicBatcher(hass, client, None, 0.01, 4, 75)
+        image = make_image(width=1280, height=720)
+        tasks = [
+            asyncio.create_task(mosaic.detect_labels(Frame(image))) for _ in range(3)
+        ]
+        await asyncio.sleep(0)
+        tasks[0].cancel()
+        # The other cameras still get their responses
+        return await asyncio.wait_for(asyncio.gather(*tasks[1:]), 5)
+
+    assert len(asyncio.run(scan())) == 2
+
+
+class ThrottlingError(Exception):
+    response = {"Error": {"Code": "ThrottlingException"}}
+
+
+def test_rate_limiter():
+    async def requests():
+        limiter = RateLimiter(max_rate=100)
+        limiter._tokens = 0.0
+        granted = []
+
+        async def request(key, priority=0):
+            if await limiter.acquire(key, priority):
+                granted.append(key)
+
+        # The first request from a is replaced by the second
+        await asyncio.gather(
+            request("a"), request("b"), request("a"), request("c", priority=1)
+        )
+        assert granted == ["c", "b", "a"]
+        assert limiter.dropped == 1
+
+        responses = [ThrottlingError(), "response"]
+
+        async def call():
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        assert await limiter.run("a", 0, call) == "response"
+        assert limiter.throttles == 1
+        assert 50 < limiter.rate < 100
+
+        # After a throttled call which took 60 ms, the next request waits for
+        # a token at the halved rate
+        limiter = RateLimiter(max_rate=20)
+        await limiter.acquire("a")
+        limiter._updated -= 0.06
+        limiter.throttled()
+        await limiter.acquire("a")
+        assert limiter.wait_time >= 0.9 / limiter.rate
+
+        # Requests waiting share one timer
+        limiter = RateLimiter(max_rate=20)
+        limiter._tokens = 0.0
+        wakeups = []
+        timer_fired = limiter._timer_fired
+        limiter._timer_fired = lambda: wakeups.append(1) or timer_fired()
+        await asyncio.gather(*(limiter.acquire(key) for key in range(8)))
+        assert len(wakeups) <= 9
+
+    asyncio.run(requests())
+
+
+def test_async_process_image_coalesce():
+    async def scan():
+        entity = make_entity(MockRekognitionClient())
+        entity.hass = MockHass(asyncio.get_running_loop())
+        images = [make_image(color=(value, value, value)) for value in (0, 1, 2, 3)]
+        await asyncio.gather(*(entity.async_process_image(image) for image in images))
+        return entity, images
+
+    entity, images = asyncio.run(scan())
+    assert entity._aws_rekognition_client.calls == 2
+    assert entity._frame.data is images[-1]
+    assert entity.extra_state_attributes["coalesced_scans"] == 2
+
+
+class FailingOnceClient(MockRekognitionClient):
+    def detect_labels(self, **kwargs):
+        if not self.calls:
+            self.calls += 1
+            raise RuntimeError("unavailable")
+        return super().detect_labels(**kwargs)
+
+
+def test_async_process_image_coalesce_error():
+    async def scan():
+        entity = make_entity(FailingOnceClient())
+        entity.hass = MockHass(asyncio.get_running_loop())
+        images = [make_image(color=(value, value, value)) for value in (0, 1, 2)]
+        results = await asyncio.wait_for(
+            asyncio.gather(
+                *(entity.async_process_image(image) for image in images),
+                return_exceptions=True,
+            ),
+            5,
+        )
+        return entity, images, results
+
+    entity, images, results = asyncio.run(scan())
+    # The image waiting behind the failed one is still processed, only once
+    assert isinstance(results[0], RuntimeError)
+    assert results[1:] == [None, None]
+    assert entity._aws_rekognition_client.calls == 2
+    assert entity._frame.data is images[-1]
+    assert entity._pending is None
+
+
+def test_histogram():
+    histogram = Histogram()
+    for value in [0.002] * 98 + [3.0, 20.0]:
+        histogram.observe(value)
+    assert histogram.count == 100
+    assert 0.001 < histogram.quantile(0.5) <= 0.0025
+    assert 2.5 < histogram.quantile(0.99) <= 5
+    assert histogram.quantile(1.0) == 10
+
+
+def test_process_image_diagnostics():
+    metrics = []
+    remove = add_metrics_listener(lambda *metric: metrics.append(metric))
+    try:
+        entity = make_entity(MockRekognitionClient(), scale=0.5, diagnostics=True)
+        entity.hass = MockHass(None)
+        entity.process_image(make_image(width=1280, height=720))
+        other = make_entity(MockRekognitionClient())
+        other.entity_id = "image_processing.rekognition_other"
+        other.hass = MockHass(None)
+        other.process_image(make_image())
+    finally:
+        remove()
+
+    attr = entity.extra_state_attributes
+    assert attr["api_calls"] == 1
+    assert attr["bytes_sent"] > 0
+    for stage in ("decode", "encode", "detect", "parse", "filter", "events"):
+        assert attr["latency_ms"][stage]["count"] == 1
+    assert (entity.entity_id, "api_calls", 1) in metrics
+    assert {metric[0] for metric in metrics} == {entity.entity_id}
+
+
+def test_process_image_label_filter():
+    entity = make_entity(
+        MockRekognitionClient(),
+        label_events=["Human", "vehicle", "automobile"],
+        label_min_confidence=99.5,
+    )
+    entity.hass = MockHass(None)
+    entity.process_image(make_image())
+    labels = [
+        event_data["name"]
+        for event_type, event_data in entity.hass.bus.events
+        if event_type == EVENT_LABEL_DETECTED
+    ]
+    assert labels == ["human", "vehicle"]
+
+
+def test_process_image_batch_events():
+    entity = make_entity(
+        MockRekognitionClient(), batch_events=True, label_min_confidence=99.5
+    )
+    entity.hass = MockHass(None)
+    entity.process_image(make_image())
+    ((event_type, event_data),) = entity.hass.bus.events
+    assert event_type == EVENT_FRAME_PROCESSED
+    assert event_data["entity_id"] == entity.entity_id
+    assert [target["name"] for target in event_data["targets"]] == ["person"] * 2
+    assert {label["name"] for label in event_data["labels"]} == {
+        "human",
+        "bike",
+        "transportation",
+        "vehicle",
+    }
+
+
+def test_attribute_profiles():
+    response = {
+        "Labels": MOCK_RESPONSE["Labels"]
+        + [
+            {"Name": f"Label{index}", "Confidence": 50.0 + index, "Instances": []}
+            for index in range(20)
+        ]
+    }
+    attributes = {}
+    for profile in ("minimal", "standard", "full"):
+        entity = make_entity(
+            MockRekognitionClient(response),
+            attributes=profile,
+            s3_client=MockS3Client(),
+            s3_bucket="bucket",
+        )
+        entity.hass = MockHass(None)
+        entity.process_image(make_image())
+        attributes[profile] = entity.extra_state_attributes
+        # Cached until the next frame is processed
+        assert entity.extra_state_attributes["summary"] is attributes[profile]["summary"]
+
+    assert set(attributes["minimal"]) == {"summary", "last_target_detection"}
+    standard = attributes["standard"]
+    assert len(standard["labels"]) == 10
+    assert standard["labels"][0]["name"] == "human"
+    assert len(standard["all_objects"]) == 5
+    assert "targets" not in standard and "s3_bucket" not in standard
+    full = attributes["full"]
+    assert len(full["labels"]) == 29
+    assert full["s3_bucket"] == "bucket"
+    assert full["targets"] == [{"target": "person", "confidence": 80}]
+
+
+def test_object_tracker():
+    tracker = ObjectTracker(min_iou=0.3, max_missed=1)
+    ids, new, departed = tracker.update(
+        ["car", "person"], [(0.1, 0.1, 0.3, 0.3), (0.5, 0.5, 0.6, 0.8)]
+    )
+    assert ids.tolist() == [1, 2] and new.tolist() == [True, True]
+
+    # The person moved a little, the car is missed once, a dog appears
+    ids, new, departed = tracker.update(
+        ["person", "dog"], [(0.52, 0.5, 0.62, 0.8), (0.1, 0.1, 0.3, 0.3)]
+    )
+    assert ids.tolist() == [2, 3] and new.tolist() == [False, True]
+    assert departed == []
+
+    ids, new, departed = tracker.update(["person"], [(0.54, 0.5, 0.64, 0.8)])
+    assert ids.tolist() == [2]
+    assert departed == [(1, "car")]
+    assert len(tracker) == 2
+
+
+def test_process_image_tracking():
+    client = MockRekognitionClient()
+    s3_client = MockS3Client()
+    entity = make_entity(
+        client,
+        tracking=True,
+        track_max_missed=0,
+        s3_client=s3_client,
+        s3_bucket="bucket",
+    )
+    entity.hass = MockHass(None)
+
+    def object_events(event_type):
+        return [data for type_, data in entity.hass.bus.events if type_ == event_type]
+
+    entity.process_image(make_image())
+    assert [data["track_id"] for data in object_events(EVENT_OBJECT_DETECTED)] == [
+        1,
+        2,
+    ]
+    entity.process_image(make_image())
+    assert len(object_events(EVENT_OBJECT_DETECTED)) == 2
+    assert len(s3_client.objects) == 1  # unchanged, so not saved again
+
+    response = dict(MOCK_RESPONSE, Labels=MOCK_RESPONSE["Labels"][:1])
+    client.response = response
+    entity.process_image(make_image())
+    assert object_events(EVENT_OBJECT_DEPARTED) == [
+        {"entity_id": entity.entity_id, "track_id": 1, "name": "person"},
+        {"entity_id": entity.entity_id, "track_id": 2, "name": "person"},
+    ]
+
+
+def make_split_image(left, right):
+    image = Image.new("RGB", (64, 48), left)
+    image.paste(right, (32, 0, 64, 48))
+    with io.BytesIO() as output:
+        image.save(output, format="JPEG")
+        return output.getvalue()
+
+
+def test_process_image_tracking_dedup():
+    client = MockRekognitionClient()
+    s3_client = MockS3Client()
+    entity = make_entity(
+        client,
+        tracking=True,
+        track_max_missed=0,
+        dedup_max_distance=0,
+        s3_client=s3_client,
+        s3_bucket="bucket",
+    )
+    entity.hass = MockHass(None)
+    people = make_split_image((0, 0, 0), (255, 255, 255))
+    empty = make_split_image((255, 255, 255), (0, 0, 0))
+
+    def object_events(event_type):
+        return [data for type_, data in entity.hass.bus.events if type_ == event_type]
+
+    entity.process_image(people)
+    client.response = dict(MOCK_RESPONSE, Labels=MOCK_RESPONSE["Labels"][:1])
+    entity.process_image(empty)
+    assert len(object_events(EVENT_OBJECT_DEPARTED)) == 2
+
+    # The people return, in a frame served from the dedup cache
+    entity.process_image(people)
+    assert client.calls == 2
+    assert entity.state == 2
+    assert [data["track_id"] for data in object_events(EVENT_OBJECT_DETECTED)] == [
+        1,
+        2,
+        3,
+        4,
+    ]
+    assert s3_client.puts == 2
+
+    # The same frame again changes nothing, so nothing is repeated
+    entity.process_image(people)
+    assert len(object_events(EVENT_OBJECT_DETECTED)) == 4
+    assert s3_client.puts == 2
+
+
+def test_save_image_encodes_once(tmp_path):
+    entity = make_entity(
+        MockRekognitionClient(),
+        save_file_folder=tmp_path,
+        save_timestamped_file=True,
+        save_quality=50,
+        save_progressive=True,
+    )
+    entity.hass = MockHass(None)
+    entity.process_image(make_image(width=640, height=480))
+    latest, timestamped = sorted(tmp_path.iterdir())[::-1]
+    assert latest.name == "rekognition_test_latest.jpg"
+    assert latest.read_bytes() == timestamped.read_bytes()
+    assert Image.open(latest).info.get("progressive")
+
+
+class MockNode:
+    def __init__(self, name, shape=None):
+        self.name = name
+        self.shape = shape
+
+
+class MockSession:
+    """Stands in for an onnxruntime InferenceSession of a 300x300 model."""
+
+    def __init__(self, scores):
+        self.scores = scores
+        self.inputs = []
+
+    def get_inputs(self):
+        return [MockNode("image_tensor", [1, 300, 300, 3])]
+
+    def get_outputs(self):
+        names = ["detection_boxes", "detection_scores", "detection_classes"]
+        return [MockNode(name) for name in names]
+
+    def run(self, output_names, inputs):
+        self.inputs.append(inputs["image_tensor"])
+        boxes = [[(0.1, 0.2, 0.5, 0.4), (0.5, 0.5, 0.9, 0.7)]]
+        return [np.array(boxes), np.array([self.scores]), np.array([[1, 2]])]
+
+
+LOCAL_LABELS = ["background", "person", "car"]
+
+
+def test_local_detector():
+    session = MockSession([0.9, 0.05])
+    detector = LocalDetector("model.onnx", LOCAL_LABELS, session=session)
+    response = detector.detect_labels(Image={"Bytes": make_image(640, 480)})
+    assert session.inputs[0].shape == (1, 300, 300, 3)
+    assert session.inputs[0].dtype == np.uint8
+    # The car is below the minimum confidence
+    objects, labels = get_objects(response)
+    assert labels == []
+    assert objects == [
+        {
+            "name": "person",
+            "confidence": 90.0,
+            "bounding_box": {
+                "x_min": 0.2,
+                "y_min": 0.1,
+                "x_max": 0.4,
+                "y_max": 0.5,
+                "width": 0.2,
+                "height": 0.4,
+            },
+            "box_area": 8.0,
+            "centroid": {"x": 0.3, "y": 0.3},
+        }
+    ]
+
+
+def test_cascade_detector():
+    session = MockSession([0.95, 0.5])
+    local = LocalDetector("model.onnx", LOCAL_LABELS, session=session)
+    remote = MockRekognitionClient()
+    cascade = CascadeDetector(local, remote, ["person"], 30, 80)
+    entity = make_entity(cascade)
+    entity.hass = MockHass(None)
+    entity.process_image(make_image())
+    assert entity.state == 1  # the uncertain car isn't a target
+    assert remote.calls == 0
+
+    session.scores = [0.6, 0.5]
+    entity.process_image(make_image())
+    assert entity.state == 2  # from Rekognition
+    assert remote.calls == 1
+    attr = entity.extra_state_attributes
+    assert attr["cascade_local_results"] == 1
+    assert attr["cascade_escalations"] == 1
+
+
+def test_result_cache(tmp_path):
+    path = tmp_path / "cache.db"
+    cache = ResultCache(path, max_bytes=6000, max_age=60)
+    key = ResultCache.key(b"image", 1.0, None)
+    assert key != ResultCache.key(b"image", 0.5, None)
+    cache.put(key, MOCK_RESPONSE, now=0)
+    assert cache.get(key, now=1) == {"Labels": MOCK_RESPONSE["Labels"]}
+    assert cache.get(key, now=61) is None  # expired
+    cache.close()
+
+    # Persists, and the least recently used response is evicted first
+    cache = ResultCache(path, max_bytes=6000, max_age=60)
+    assert cache.get(key, now=2) is not None
+    other = ResultCache.key(b"other")
+    cache.put(other, MOCK_RESPONSE, now=3)
+    cache.get(key, now=4)
+    cache.put(ResultCache.key(b"third"), MOCK_RESPONSE, now=5)
+    assert len(cache) == 2
+    assert cache.get(other, now=6) is None
+    assert cache.get(key, now=6) is not None
+
+
+def test_process_image_result_cache(tmp_path):
+    client = MockRekognitionClient()
+    cache = ResultCache(tmp_path / "cache.db", max_bytes=1024 * 1024)
+    entities = [make_entity(client, result_cache=cache) for _ in range(2)]
+    for entity in entities:
+        entity.hass = MockHass(None)
+        entity.process_image(make_image())
+    assert client.calls == 1
+    assert [entity.state for entity in entities] == [2, 2]
+    assert entities[1].extra_state_attributes["result_cache_hits"] == 1
+    assert entities[0].extra_state_attributes["result_cache_misses"] == 1
+
+    # Local models only share the results of the same model
+    sessions = [MockSession([0.9, 0.9]) for _ in range(3)]
+    detectors = [
+        LocalDetector(path, LOCAL_LABELS, session=session)
+        for path, session in zip(["a.onnx", "b.onnx", "a.onnx"], sessions)
+    ]
+    for detector in detectors:
+        entity = make_entity(detector, result_cache=cache)
+        entity.hass = MockHass(None)
+        entity.process_image(make_image())
+    assert [len(session.inputs) for session in sessions] == [1, 1, 0]
+
+
+class MockCameraImage:
+    def __init__(self, content):
+        self.content = content
+
+
+def test_fan_out(monkeypatch):
+    fetches = []
+
+    async def async_get_image(hass, entity_id, timeout=10):
+        fetches.append(entity_id)
+        await asyncio.sleep(0.01)
+        return MockCameraImage(make_image())
+
+    monkeypatch.setattr(image_processing.camera, "async_get_image", async_get_image)
+
+    async def scan():
+        client = MockRekognitionClient()
+        fan_out = FanOut()
+        people = make_entity(client, fan_out=fan_out)
+        cars = make_entity(client, fan_out=fan_out, targets=[{"target": "car"}])
+        left = make_entity(client, fan_out=fan_out, roi_x_max=0.5)
+        entities = [people, cars, left]
+        for entity in entities:
+            entity.hass = MockHass(asyncio.get_running_loop())
+        await asyncio.gather(*(entity.async_update() for entity in entities))
+        calls = client.calls
+        # A later scan fetches a new image
+        await people.async_update()
+        return calls, entities
+
+    calls, entities = asyncio.run(scan())
+    assert fetches == ["camera.test", "camera.test"]
+    assert calls == 1
+    assert [entity.state for entity in entities] == [2, 1, 1]
+    shared = [entity.extra_state_attributes["shared_detections"] for entity in entities]
+    # The later scan got an identical image, so reused the response too
+    assert shared == [1, 1, 1]
+
+
+def test_fan_out_replaced():
+    async def scan():
+        client = MockRekognitionClient()
+        fan_out = FanOut()
+        rate_limiter = RateLimiter(max_rate=5)
+        rate_limiter._tokens = 0.0
+        a, b = [
+            make_entity(
+                client,
+                fan_out=fan_out,
+                rate_limiter=rate_limiter,
+                max_concurrent_requests=2,
+            )
+            for _ in range(2)
+        ]
+        b.entity_id = "image_processing.rekognition_other"
+        for entity in (a, b):
+            entity.hass = MockHass(asyncio.get_running_loop())
+        first = asyncio.create_task(a.async_process_image(make_image()))
+        await asyncio.sleep(0.05)
+        shared = asyncio.create_task(b.async_process_image(make_image()))
+        await asyncio.sleep(0.05)
+        # a's newer frame replaces the request b is sharing
+        newer = make_image(color=(255, 255, 255))
+        await asyncio.gather(first, shared, a.async_process_image(newer))
+        return client, b
+
+    client, b = asyncio.run(scan())
+    assert client.calls == 2
+    assert b.state == 2
+
+
+def test_jpeg_frames():
+    images = [make_image(color=(index * 60, 0, 0)) for index in range(3)]
+    stream = io.BytesIO(b"--boundary\r\n".join(images) + b"\r\n")
+    assert list(jpeg_frames(stream, chunk_size=100)) == images
+
+
+def test_stream_processor():
+    def source():
+        for index in range(5):
+            yield make_image(color=(index * 50, 0, 0))
+
+    async def stream():
+        client = MockRekognitionClient()
+        rate_limiter = RateLimiter(max_rate=100)
+        entity = make_entity(client, rate_limiter=rate_limiter)
+        entity.hass = MockHass(asyncio.get_running_loop())
+        writes = []
+        entity.async_write_ha_state = lambda: writes.append(entity.state)
+        processor = StreamProcessor(entity, source, interval=0, idle_interval=0)
+        processor.start()
+        while processor.processed + processor.dropped < 5:
+            await asyncio.sleep(0.01)
+        processor.stop()
+        assert entity.entity_id in rate_limiter._served
+        return processor, writes
+
+    processor, writes = asyncio.run(stream())
+    assert processor.read == processor.sampled == 5
+    assert processor.processed >= 1
+    assert writes == [2] * processor.processed
+
+    processor = StreamProcessor(None, source, interval=1, idle_interval=5)
+    assert processor.interval == 5
+    processor.activate()
+    assert processor.interval == 1
+
+
+def test_snapshot_archive(tmp_path):
+    old = tmp_path / "cam_2021-01-01_12.00.00.jpg"
+    old.write_bytes(b"old")
+    created = time.mktime((2021, 1, 1, 12, 0, 0, 0, 0, -1))
+    os.utime(old, (created, created))
+    (tmp_path / "cam_latest.jpg").write_bytes(b"latest")
+    # Images of a camera whose name starts with this one's
+    (tmp_path / "cam_door_2021-01-01_12.00.00.jpg").write_bytes(b"door")
+    (tmp_path / "cam_2021-01-01_12.00.00_door.jpg").write_bytes(b"door")
+    archive = SnapshotArchive(tmp_path)
+    archive.set_limits("cam", suffix=".jpg")
+    archive.close()
+    # The image saved before the archive was moved into its day folder
+    assert archive.files("cam") == 1
+    assert (tmp_path / "2021-01-01" / old.name).exists()
+    assert (tmp_path / "cam_latest.jpg").exists()
+    assert (tmp_path / "cam_door_2021-01-01_12.00.00.jpg").exists()
+    assert (tmp_path / "cam_2021-01-01_12.00.00_door.jpg").exists()
+
+    archive = SnapshotArchive(tmp_path)
+    assert archive.files("cam") == 1
+    archive.set_limits("cam", max_files=3, max_bytes=100, max_age=60)
+    archive.set_limits("other")
+    now = time.time()
+    paths = []
+    for index in range(5):
+        path = archive.path(f"cam_{index}.jpg", "2022-02-02")
+        path.write_bytes(b"x" * 10)
+        archive.add("cam", path, 10, now + index)
+        paths.append(path)
+    other = archive.path("other_0.jpg", "2022-02-02")
+    other.write_bytes(b"x" * 200)
+    archive.add("other", other, 200, now)
+
+    # The background thread may have evicted them already
+    archive.evict("cam", now)  # the adopted image and 2 more
+    assert [path.exists() for path in paths] == [False, False, True, True, True]
+    assert (archive.files("cam"), archive.size("cam")) == (3, 30)
+
+    archive.set_limits("cam", max_bytes=25)
+    archive.evict("cam", now)
+    assert archive.size("cam") == 20
+    archive.set_limits("cam", max_age=60)
+    assert archive.evict("cam", now + 64) == 1
+    assert archive.evict("other", now + 3600) == 0  # no limits
+    archive.close()
+    assert archive.evicted == 5
+
+    # Empty day folders are removed with their last image
+    assert not (tmp_path / "2021-01-01").exists()
+    assert other.exists()
+
+
+def test_save_image_archive(tmp_path):
+    archive = SnapshotArchive(tmp_path)
+    entity = make_entity(
+        MockRekognitionClient(),
+        save_file_folder=tmp_path,
+        save_timestamped_file=True,
+        archive=archive,
+        save_max_files=1,
+    )
+    entity.hass = MockHass(None)
+    entity.process_image(make_image())
+    saved = Path(entity.save_latest())
+    assert saved.parent == tmp_path / entity._last_detection[:10]
+    assert archive.files(entity.name) == 1
+    assert entity.extra_state_attributes["saved_files"] == 1
+    archive.close()